@@ -21,6 +21,22 @@ except ImportError:
     }))
     sys.exit(1)
 
+# 共享的辅助模块位于 src/scripts 目录
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src' / 'scripts'))
+
+from resource_governor import ResourceGovernor, AdmissionTimeout
+from dashscope_client import call_multimodal, response_text
+from model_cascade import (REQUIRED_FIELDS, apply_stage_fps, load_cascade_stages, parse_model_json, record_cascade,
+                           run_cascade, validate_result)
+from deadline import Deadline, DeadlineExceeded
+from continuation import finish_reason, is_truncated, resume_truncated
+from key_pool import load_keys
+from audio_analysis import analyze_audio, prompt_context
+from mp4_probe import probe_mp4
+
+# 剩余时间少于该值时不再做Base64编码，直接使用file://协议
+LOW_BUDGET_SECONDS = 60
+
 def load_env():
     """加载环境变量"""
     # 脚本在scripts目录中，.env文件在backend目录中
@@ -40,7 +56,14 @@ def load_env():
                         value = value[1:-1]
                     os.environ[key.strip()] = value
 
-def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="", video_path2=""):
+def with_audio(data, audio):
+    """把本地音频分析结果放进data，与src/scripts/video_analyzer.py的rawAnalysis.audio一致"""
+    if isinstance(data, dict):
+        return dict(data, audio=audio)
+    return data
+
+def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="", video_path2="", upload_mode="auto",
+                           deadline=None):
     """
     使用DashScope Python SDK分析本地视频文件
 
@@ -49,20 +72,24 @@ def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="",
         analysis_type: 分析类型 (content/fusion)
         extra_prompt: 额外的提示词
         video_path2: 第二个视频文件路径（仅用于融合分析）
+        upload_mode: 上传方式，auto按文件大小选择，file强制使用file://协议（内存占用更低）
+        deadline: Deadline，模型调用的超时不超过剩余时间
 
     Returns:
-        分析结果JSON字符串
+        分析结果JSON字符串；截止时间到达时data只包含已完成阶段的结果并标记partial
     """
+    # 已完成阶段的结果，截止时间到达时作为部分结果返回
+    completed = {}
     try:
-        # 设置API密钥
-        api_key = os.getenv('DASHSCOPE_API_KEY')
-        if not api_key:
+        # 设置API密钥：配置多个Key时由调用层按负载从Key池中分配
+        api_keys = load_keys()
+        if not api_keys:
             return json.dumps({
                 "success": False,
-                "error": "未设置DASHSCOPE_API_KEY环境变量"
+                "error": "未设置DASHSCOPE_API_KEY或DASHSCOPE_API_KEYS环境变量"
             })
 
-        dashscope.api_key = api_key
+        dashscope.api_key = api_keys[0]
 
         # 确保视频文件存在 - 使用更robust的检查方法
         print(f"[DEBUG] 检查文件路径: {video_path}", file=sys.stderr)
@@ -95,8 +122,23 @@ def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="",
             })
         print(f"视频文件大小: {file_size} 字节 ({file_size/1024/1024:.2f} MB)", file=sys.stderr)
 
+        # 只读文件头的元数据，不启动解码器；截止时间到达时至少能返回这些信息
+        meta = probe_mp4(video_path) or {}
+        completed.update({
+            "duration": meta.get("duration"),
+            "frameRate": meta.get("frameRate"),
+            "resolution": f"{meta['width']}x{meta['height']}" if meta.get("width") and meta.get("height") else None,
+            "frames": meta.get("frames")
+        })
+        if deadline is not None:
+            deadline.mark('metadata')
+
+        if deadline is not None and deadline.is_short(LOW_BUDGET_SECONDS):
+            print(f"剩余时间 {deadline.remaining():.0f}秒，跳过Base64编码", file=sys.stderr)
+            upload_mode = "file"
+
         # 如果文件小于10MB，使用Base64编码
-        if file_size < 10 * 1024 * 1024:  # 10MB
+        if file_size < 10 * 1024 * 1024 and upload_mode != "file":  # 10MB
             print("使用Base64编码方式传输视频", file=sys.stderr)
             import base64
 
@@ -125,6 +167,24 @@ def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="",
 
             print(f"分析视频文件: {file_url}", file=sys.stderr)
 
+        # 本地音频分析：模型只看到抽帧画面，节奏和音频相关字段以本地计算的结果为依据
+        audio = None
+        if not (deadline and deadline.is_short(LOW_BUDGET_SECONDS)):
+            timeout = deadline.budget(cap=30) if deadline is not None else 30
+            if analysis_type == "fusion" and video_path2 and os.path.exists(video_path2):
+                audio = {"video1": analyze_audio(video_path, timeout=timeout),
+                         "video2": analyze_audio(video_path2, timeout=timeout)}
+                audio_prompt = "\n".join(filter(None, [prompt_context(audio["video1"], "视频1"),
+                                                       prompt_context(audio["video2"], "视频2")]))
+            else:
+                audio = analyze_audio(video_path, timeout=timeout)
+                audio_prompt = prompt_context(audio)
+            if audio_prompt:
+                extra_prompt = f"{audio_prompt}\n{extra_prompt}" if extra_prompt else audio_prompt
+            completed["audio"] = audio
+            if deadline is not None:
+                deadline.mark('audio')
+
         # 根据分析类型选择提示词
         if analysis_type == "content":
             system_prompt = "你是一名专业的视频分析师，具有深厚的视觉分析和内容解读能力。请用JSON格式返回分析结果。"
@@ -249,7 +309,7 @@ def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="",
             print(f"第二个视频文件大小: {file_size2} 字节 ({file_size2/1024/1024:.2f} MB)", file=sys.stderr)
 
             # 如果第二个文件小于10MB，使用Base64编码
-            if file_size2 < 10 * 1024 * 1024:  # 10MB
+            if file_size2 < 10 * 1024 * 1024 and upload_mode != "file":  # 10MB
                 print("使用Base64编码方式传输第二个视频", file=sys.stderr)
                 import base64
 
@@ -292,14 +352,36 @@ def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="",
             }
         ]
 
-        # 调用DashScope API
-        response = MultiModalConversation.call(
-            model='qwen3-vl-plus',
-            messages=messages,
-            result_format='message',
-            max_tokens=4000,
-            temperature=0.2
-        )
+        # 调用DashScope API（启用DASHSCOPE_HEDGE时对慢请求发出对冲请求）
+        payload_bytes = file_size + (os.path.getsize(video_path2) if analysis_type == "fusion" and video_path2 else 0)
+
+        def call_model(model_messages, model):
+            return call_multimodal(
+                model_messages,
+                model,
+                payload_bytes=payload_bytes,
+                timeout=deadline.budget(reserve=3) if deadline is not None else None,
+                result_format='message',
+                max_tokens=4000,
+                temperature=0.2
+            )
+
+        def call_stage(stage):
+            return call_model(apply_stage_fps(messages, stage["fps"]), stage["model"])
+
+        def evaluate(result):
+            stage_response = result[0]
+            if stage_response.status_code != 200:
+                return False, [f"api_error:{stage_response.code}"]
+            return validate_result(parse_model_json(response_text(stage_response)), analysis_type)
+
+        # 分级模型级联：快速模型的结果未通过检查时才升级到重量级模型
+        (response, call_info), cascade_info = run_cascade(load_cascade_stages(2), call_stage, evaluate,
+                                                              deadline=deadline)
+        record_cascade(analysis_type, cascade_info)
+        final_fps = cascade_info["attempts"][-1]["fps"]
+        if deadline is not None:
+            deadline.mark('model_call')
 
         if response.status_code == 200:
             # 根据文档，message格式下的响应结构
@@ -315,6 +397,31 @@ def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="",
             if not isinstance(content, str):
                 content = str(content)
 
+            # 输出被max_tokens截断时从断点续写，而不是返回无法解析的文本让用户重跑
+            if is_truncated(content, finish_reason(response)) and not (deadline and deadline.is_short(LOW_BUDGET_SECONDS)):
+                required = REQUIRED_FIELDS.get(analysis_type, REQUIRED_FIELDS["content"])["keys"]
+                analysis_result, continuation_info = resume_truncated(
+                    apply_stage_fps(messages, final_fps), content, response,
+                    lambda msgs: call_model(msgs, cascade_info["model"])[0],
+                    expected_keys=required, first_latency=call_info.get("latency")
+                )
+                if analysis_result is not None:
+                    if not continuation_info["complete"]:
+                        # 只抢救出了截断前已完整输出的字段，在data中标记，调用方不会把它当作完整分析
+                        analysis_result = dict(analysis_result, partial=True, partial_stage='model_call')
+                    return json.dumps({
+                        "success": True,
+                        "data": with_audio(analysis_result, audio),
+                        "raw_content": content,
+                        "usage": {
+                            "input_tokens": response.usage.input_tokens if hasattr(response, 'usage') else None,
+                            "output_tokens": response.usage.output_tokens if hasattr(response, 'usage') else None
+                        },
+                        "call": call_info,
+                        "cascade": cascade_info,
+                        "continuation": continuation_info
+                    })
+
             # 尝试解析JSON格式的结果
             try:
                 # 清理可能的markdown格式
@@ -328,12 +435,14 @@ def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="",
 
                 return json.dumps({
                     "success": True,
-                    "data": analysis_result,
+                    "data": with_audio(analysis_result, audio),
                     "raw_content": content,
                     "usage": {
                         "input_tokens": response.usage.input_tokens if hasattr(response, 'usage') else None,
                         "output_tokens": response.usage.output_tokens if hasattr(response, 'usage') else None
-                    }
+                    },
+                    "call": call_info,
+                    "cascade": cascade_info
                 })
             except json.JSONDecodeError as e:
                 # 如果无法解析JSON，返回原始文本
@@ -341,10 +450,13 @@ def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="",
                     "success": True,
                     "data": {
                         "analysis_text": content,
-                        "structured": False
+                        "structured": False,
+                        "audio": audio
                     },
                     "raw_content": content,
-                    "parsing_error": str(e)
+                    "parsing_error": str(e),
+                    "call": call_info,
+                    "cascade": cascade_info
                 })
         else:
             return json.dumps({
@@ -354,6 +466,13 @@ def analyze_video_with_sdk(video_path, analysis_type="content", extra_prompt="",
                 "request_id": response.request_id
             })
 
+    except (TimeoutError, DeadlineExceeded) as e:
+        # 与src/scripts/video_analyzer.py一致：返回元数据和已完成阶段的结果，而不是只有错误信息
+        return json.dumps({
+            "success": True,
+            "data": dict(completed, partial=True, partial_stage=getattr(e, 'stage', 'model_call'),
+                         error_message=f"分析在截止时间内未完成: {str(e)}")
+        })
     except Exception as e:
         return json.dumps({
             "success": False,
@@ -369,12 +488,20 @@ def main():
     parser.add_argument('--type', default='content', choices=['content', 'fusion'], help='分析类型')
     parser.add_argument('--prompt', default='', help='额外提示词')
     parser.add_argument('--debug', action='store_true', help='启用调试模式')
+    parser.add_argument('--fusion-library', default='', help='融合分析未指定第二个视频时，从该目录预排序选出最佳搭档')
+    parser.add_argument('--memory-budget-mb', type=float, default=None, help='所有并发分析任务的内存预算（MB）')
+    parser.add_argument('--admission-timeout', type=float, default=120, help='等待内存预算的最长时间（秒）')
+    parser.add_argument('--deadline', type=float, default=None, help='整个分析的截止时间（秒），0表示不限时')
 
     args = parser.parse_args()
 
     # 加载环境变量
     load_env()
 
+    if args.deadline is None:
+        args.deadline = float(os.getenv('ANALYSIS_DEADLINE', '0'))
+    deadline = Deadline(args.deadline)
+
     # 调试模式
     if args.debug:
         api_key = os.getenv('DASHSCOPE_API_KEY')
@@ -385,11 +512,54 @@ def main():
         print(f"调试信息: 视频文件路径: {args.video_path}")
         print(f"调试信息: 视频文件是否存在: {os.path.exists(args.video_path)}")
 
+    # 融合分析未指定第二个视频时，先在本地视频库中预排序，只把最佳候选送给模型
+    pairing = None
+    if args.type == 'fusion' and not args.video_path2 and args.fusion_library:
+        try:
+            from frame_pool import FramePool
+            from fusion_pairing import shortlist, list_videos
+            # 描述子从共享内存帧池读取帧，常驻帧数据受帧池内存预算约束
+            with FramePool() as frame_pool:
+                pairing = shortlist(list_videos(args.fusion_library), args.video_path, top_k=5, pool=frame_pool)
+            if pairing.get("success") and pairing["candidates"]:
+                args.video_path2 = pairing["candidates"][0]["video2"]
+                print(f"融合预排序选出搭档视频: {args.video_path2}", file=sys.stderr)
+        except ImportError as e:
+            print(f"融合预排序需要numpy和opencv-python: {e}", file=sys.stderr)
+            pairing = {"success": False, "error": f"融合预排序需要numpy和opencv-python: {e}"}
+        except Exception as e:
+            # 预排序失败（如视频库目录不存在）时按未指定第二个视频继续，错误随结果JSON一起输出
+            print(f"融合预排序失败: {e}", file=sys.stderr)
+            pairing = {"success": False, "error": f"融合预排序失败: {e}"}
+
+    # 内存准入控制：估算峰值内存，超出预算时排队或改用file://方式
+    file_sizes = [os.path.getsize(p) for p in (args.video_path, args.video_path2) if p and os.path.exists(p)]
+    budget_mb = args.memory_budget_mb or float(os.getenv('MEMORY_BUDGET_MB', '2048'))
+    # 本地音频分析在任务内解码音轨；预排序虽在准入前完成，其解码峰值也计入本进程的RSS峰值
+    decode = bool(pairing and pairing.get("success")) or not deadline.is_short(LOW_BUDGET_SECONDS)
+    try:
+        admission = ResourceGovernor(budget_mb=budget_mb).admit(file_sizes, decode=decode,
+                                                                timeout=deadline.budget(cap=args.admission_timeout))
+    except AdmissionTimeout as e:
+        print(json.dumps({
+            "success": False,
+            "error": f"服务器繁忙: {str(e)}"
+        }))
+        return
+
     # 执行分析
-    result = analyze_video_with_sdk(args.video_path, args.type, args.prompt, args.video_path2)
+    with admission:
+        result = json.loads(analyze_video_with_sdk(
+            args.video_path, args.type, args.prompt, args.video_path2, upload_mode=admission.mode,
+            deadline=deadline
+        ))
+        result["resources"] = admission.report()
+        result["deadline"] = deadline.report()
+        if pairing:
+            result["pairing"] = pairing
 
     # 输出结果
-    print(result)
+    print(json.dumps(result))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地音频分析
+通过ffmpeg把音轨解码为单声道PCM，按块流式读入NumPy数组，向量化计算响度（RMS/LUFS）、静音段、
+起音强度（onset）、节拍和速度，并给出与节拍对齐的候选剪辑点；
+结果附加到分析结果中，压缩后的摘要作为上下文提供给模型
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import tempfile
+import threading
+import subprocess
+
+DEFAULT_SAMPLE_RATE = 22050
+N_FFT = 2048
+HOP = 512
+CHUNK_SECONDS = 10
+
+SILENCE_DBFS = -45.0
+MIN_SILENCE_SECONDS = 0.3
+
+# BPM搜索范围，先验集中在120附近
+MIN_BPM = 60
+MAX_BPM = 180
+PRIOR_BPM = 120
+
+MAX_CUT_POINTS = 20
+MIN_CUT_SPACING = 1.0
+
+# BS.1770 门限
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+BLOCK_SECONDS = 0.4
+
+
+def iter_pcm_chunks(video_path, sample_rate=DEFAULT_SAMPLE_RATE, chunk_seconds=CHUNK_SECONDS, timeout=None):
+    """
+    用ffmpeg解码音轨，按块产出float32单声道样本
+
+    stderr写入临时文件而不是管道，避免ffmpeg输出大量错误时写满管道而阻塞；
+    超时由定时器直接终止ffmpeg，阻塞中的读取随之结束
+
+    Raises:
+        RuntimeError: ffmpeg不可用、没有音轨、解码失败或超时
+    """
+    import numpy as np
+
+    cmd = ['ffmpeg', '-v', 'error', '-nostdin', '-i', video_path, '-map', '0:a:0', '-vn',
+           '-ac', '1', '-ar', str(sample_rate), '-f', 'f32le', '-']
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        except OSError as e:
+            raise RuntimeError(f"ffmpeg不可用: {e}")
+
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            proc.kill()
+
+        watchdog = threading.Timer(timeout, kill) if timeout is not None else None
+        if watchdog:
+            watchdog.daemon = True
+            watchdog.start()
+
+        chunk_bytes = int(sample_rate * chunk_seconds) * 4
+        received = 0
+        try:
+            while True:
+                data = proc.stdout.read(chunk_bytes)
+                if not data:
+                    break
+                usable = len(data) - len(data) % 4
+                received += usable
+                yield np.frombuffer(data[:usable], dtype=np.float32)
+            proc.wait()
+            if timed_out.is_set():
+                raise RuntimeError(f"音频解码超过 {timeout:.0f}秒")
+            if received == 0:
+                stderr.seek(0)
+                error = stderr.read().decode('utf-8', 'replace').strip()
+                raise RuntimeError(error.splitlines()[-1] if error else "视频没有音轨")
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+
+def _biquad_response(b, a, w):
+    """二阶滤波器在归一化角频率w处的幅度平方响应"""
+    import numpy as np
+    z = np.exp(-1j * w)
+    h = (b[0] + b[1] * z + b[2] * z ** 2) / (a[0] + a[1] * z + a[2] * z ** 2)
+    return np.abs(h) ** 2
+
+
+def k_weighting(sample_rate, n_fft=N_FFT):
+    """
+    BS.1770 K加权（高架滤波 + 高通）在rfft各频点的功率增益
+
+    在频域按帧加权，避免逐样本的IIR滤波
+    """
+    import numpy as np
+
+    w = 2 * np.pi * np.fft.rfftfreq(n_fft, 1 / sample_rate) / sample_rate
+
+    # 高架：+4dB，1500Hz，Q=1/sqrt(2)
+    gain_db, fc, q = 4.0, 1500.0, 1 / np.sqrt(2)
+    amp = 10 ** (gain_db / 40)
+    w0 = 2 * np.pi * fc / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos0 = np.cos(w0)
+    shelf_b = [amp * ((amp + 1) + (amp - 1) * cos0 + 2 * np.sqrt(amp) * alpha),
+               -2 * amp * ((amp - 1) + (amp + 1) * cos0),
+               amp * ((amp + 1) + (amp - 1) * cos0 - 2 * np.sqrt(amp) * alpha)]
+    shelf_a = [(amp + 1) - (amp - 1) * cos0 + 2 * np.sqrt(amp) * alpha,
+               2 * ((amp - 1) - (amp + 1) * cos0),
+               (amp + 1) - (amp - 1) * cos0 - 2 * np.sqrt(amp) * alpha]
+
+    # 高通：38Hz，Q=0.5
+    fc, q = 38.0, 0.5
+    w0 = 2 * np.pi * fc / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos0 = np.cos(w0)
+    hp_b = [(1 + cos0) / 2, -(1 + cos0), (1 + cos0) / 2]
+    hp_a = [1 + alpha, -2 * cos0, 1 - alpha]
+
+    return _biquad_response(shelf_b, shelf_a, w) * _biquad_response(hp_b, hp_a, w)
+
+
+class FrameFeatures:
+    """逐块累积帧级特征：RMS、峰值、K加权均方和谱通量，只保留帧级数据而不保留PCM"""
+
+    def __init__(self, sample_rate):
+        import numpy as np
+
+        self.sample_rate = sample_rate
+        self.window = np.hanning(N_FFT).astype(np.float32)
+        self.window_power = float((self.window ** 2).sum())
+        self.k_gain = k_weighting(sample_rate)
+        # rfft单边谱按Parseval折算为时域能量时，除直流和奈奎斯特外的频点计两次
+        self.bin_weight = np.full(N_FFT // 2 + 1, 2.0)
+        self.bin_weight[[0, -1]] = 1.0
+        self.carry = np.zeros(0, dtype=np.float32)
+        self.prev_log_mag = None
+        self.samples = 0
+        self.rms = []
+        self.peak = []
+        self.k_power = []
+        self.flux = []
+
+    def feed(self, chunk):
+        import numpy as np
+        from numpy.lib.stride_tricks import sliding_window_view
+
+        self.samples += len(chunk)
+        signal = np.concatenate([self.carry, chunk])
+        if len(signal) < N_FFT:
+            self.carry = signal
+            return
+        n_frames = (len(signal) - N_FFT) // HOP + 1
+        frames = sliding_window_view(signal, N_FFT)[::HOP][:n_frames]
+        # 下一块从第一个未处理帧的起点继续
+        self.carry = signal[n_frames * HOP:]
+
+        self.rms.append(np.sqrt(np.mean(frames[:, :HOP] ** 2, axis=1)))
+        self.peak.append(np.abs(frames[:, :HOP]).max(axis=1))
+
+        spectrum = np.fft.rfft(frames * self.window, axis=1)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        self.k_power.append((power * self.k_gain * self.bin_weight).sum(axis=1) / N_FFT / self.window_power)
+
+        log_mag = np.log1p(100 * np.sqrt(power))
+        prev = self.prev_log_mag if self.prev_log_mag is not None else log_mag[:1]
+        diff = np.diff(np.vstack([prev, log_mag]), axis=0)
+        self.flux.append(np.maximum(diff, 0).sum(axis=1))
+        self.prev_log_mag = log_mag[-1:]
+
+    def arrays(self):
+        import numpy as np
+        join = (lambda parts: np.concatenate(parts) if parts else np.zeros(0))
+        return join(self.rms), join(self.peak), join(self.k_power), join(self.flux)
+
+
+def integrated_loudness(k_power, frame_rate):
+    """按BS.1770的400ms块（75%重叠）和绝对/相对门限计算整体响度（LUFS）"""
+    import numpy as np
+
+    block = max(1, int(round(BLOCK_SECONDS * frame_rate)))
+    step = max(1, block // 4)
+    if len(k_power) < block:
+        blocks = np.array([k_power.mean()]) if len(k_power) else np.zeros(0)
+    else:
+        cumulative = np.concatenate([[0.0], np.cumsum(k_power)])
+        starts = np.arange(0, len(k_power) - block + 1, step)
+        blocks = (cumulative[starts + block] - cumulative[starts]) / block
+    blocks = blocks[blocks > 0]
+    if not len(blocks):
+        return None
+    lufs = -0.691 + 10 * np.log10(blocks)
+    gated = blocks[lufs > ABSOLUTE_GATE_LUFS]
+    if not len(gated):
+        return None
+    relative = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE_LU
+    gated = gated[-0.691 + 10 * np.log10(gated) > relative]
+    return float(-0.691 + 10 * np.log10(gated.mean()))
+
+
+def silence_segments(rms_db, frame_rate, threshold=SILENCE_DBFS, min_seconds=MIN_SILENCE_SECONDS):
+    """连续低于阈值的帧组成的静音段 [(开始秒, 结束秒)]"""
+    import numpy as np
+
+    quiet = np.concatenate([[False], rms_db < threshold, [False]])
+    edges = np.flatnonzero(np.diff(quiet.astype(np.int8)))
+    starts, ends = edges[0::2], edges[1::2]
+    keep = (ends - starts) >= min_seconds * frame_rate
+    return [(round(float(s) / frame_rate, 2), round(float(e) / frame_rate, 2))
+            for s, e in zip(starts[keep], ends[keep])]
+
+
+def onset_envelope(flux):
+    """去除缓慢变化的基线并归一化的起音强度曲线"""
+    import numpy as np
+
+    if not len(flux):
+        return flux
+    width = min(len(flux), 16)
+    baseline = np.convolve(flux, np.ones(width) / width, mode='same')
+    env = np.maximum(flux - baseline, 0)
+    scale = env.max()
+    return env / scale if scale > 0 else env
+
+
+def pick_onsets(env, frame_rate, delta=0.1):
+    """局部最大且高于均值+delta的帧为起音点"""
+    import numpy as np
+
+    if len(env) < 3:
+        return np.zeros(0, dtype=int)
+    local_max = (env[1:-1] >= env[:-2]) & (env[1:-1] > env[2:])
+    strong = env[1:-1] > env.mean() + delta
+    candidates = np.flatnonzero(local_max & strong) + 1
+    # 合并间隔小于50ms的起音
+    if len(candidates):
+        gap = max(1, int(0.05 * frame_rate))
+        candidates = candidates[np.concatenate([[True], np.diff(candidates) > gap])]
+    return candidates
+
+
+def estimate_tempo(env, frame_rate):
+    """
+    起音曲线自相关估计速度
+
+    Returns:
+        (BPM, 置信度, 节拍周期帧数)，无法估计时返回 (None, 0.0, None)
+    """
+    import numpy as np
+
+    min_lag = int(frame_rate * 60 / MAX_BPM)
+    max_lag = int(frame_rate * 60 / MIN_BPM)
+    if len(env) < max_lag * 2 or not env.any():
+        return None, 0.0, None
+
+    x = env - env.mean()
+    n = 1 << int(np.ceil(np.log2(2 * len(x))))
+    spectrum = np.fft.rfft(x, n)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum), n)[:max_lag + 1]
+    if acf[0] <= 0:
+        return None, 0.0, None
+    acf = acf / acf[0]
+
+    lags = np.arange(min_lag, max_lag + 1)
+    bpm = 60 * frame_rate / lags
+    prior = np.exp(-0.5 * (np.log2(bpm / PRIOR_BPM) / 1.0) ** 2)
+    score = acf[lags] * prior
+    best = int(np.argmax(score))
+    lag = int(lags[best])
+    confidence = float(np.clip(acf[lag], 0, 1))
+    # 抛物线插值得到亚帧精度的周期，避免帧率量化导致的速度偏差
+    fine_lag = float(lag)
+    if min_lag < lag < max_lag:
+        left, center, right = acf[lag - 1], acf[lag], acf[lag + 1]
+        curvature = left - 2 * center + right
+        if curvature < 0:
+            fine_lag += 0.5 * (left - right) / curvature
+    return round(float(60 * frame_rate / fine_lag), 1), round(confidence, 3), lag
+
+
+def track_beats(env, period):
+    """按估计的周期选择起音能量最大的相位，并把每拍微调到附近的起音峰值"""
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    usable = len(env) // period * period
+    phase = int(np.argmax(env[:usable].reshape(-1, period).sum(axis=0)))
+    beats = np.arange(phase, len(env), period)
+
+    radius = max(1, period // 10)
+    padded = np.pad(env, radius)
+    windows = sliding_window_view(padded, 2 * radius + 1)[beats]
+    return beats + np.argmax(windows, axis=1) - radius
+
+
+def cut_points(beats, env, silences, frame_rate, limit=MAX_CUT_POINTS):
+    """
+    与节拍对齐的候选剪辑点
+
+    每拍按起音强度打分；每4拍中最强的相位视为小节重拍并加分，靠近静音段边界的拍也加分，
+    按得分从高到低选出间隔不小于MIN_CUT_SPACING的点
+    """
+    import numpy as np
+
+    if not len(beats):
+        return []
+    strength = env[beats]
+    score = strength.copy()
+    reasons = [["onset"] for _ in beats]
+
+    if len(beats) >= 8:
+        usable = len(beats) // 4 * 4
+        downbeat_phase = int(np.argmax(strength[:usable].reshape(-1, 4).sum(axis=0)))
+        downbeats = np.arange(downbeat_phase, len(beats), 4)
+        score[downbeats] += 0.5
+        for i in downbeats:
+            reasons[i].append("downbeat")
+
+    if silences:
+        times = beats / frame_rate
+        bounds = np.array([t for seg in silences for t in seg])
+        near = np.abs(times[:, None] - bounds[None, :]).min(axis=1) < 0.25
+        score[near] += 0.3
+        for i in np.flatnonzero(near):
+            reasons[i].append("silence_edge")
+
+    chosen = []
+    for i in np.argsort(-score):
+        t = beats[i] / frame_rate
+        if all(abs(t - c["time"]) >= MIN_CUT_SPACING for c in chosen):
+            chosen.append({"time": round(float(t), 2), "score": round(float(score[i]), 3), "reasons": reasons[i]})
+        if len(chosen) >= limit:
+            break
+    return sorted(chosen, key=lambda c: c["time"])
+
+
+def _energy_profile(rms_db, frame_rate, segments=8):
+    """把整段RMS分成若干段，返回每段的平均电平（dBFS）"""
+    import numpy as np
+
+    if not len(rms_db):
+        return []
+    parts = np.array_split(rms_db, min(segments, len(rms_db)))
+    return [round(float(p.mean()), 1) for p in parts]
+
+
+def analyze_pcm_chunks(chunks, sample_rate=DEFAULT_SAMPLE_RATE):
+    """
+    对PCM块序列做完整分析
+
+    Args:
+        chunks: 产出float32单声道样本数组的可迭代对象
+
+    Returns:
+        分析结果字典
+    """
+    import numpy as np
+
+    features = FrameFeatures(sample_rate)
+    for chunk in chunks:
+        features.feed(chunk)
+    rms, peak, k_power, flux = features.arrays()
+    frame_rate = sample_rate / HOP
+    duration = features.samples / sample_rate
+    if not len(rms):
+        return {"has_audio": False, "duration": round(duration, 2), "error": "音频太短，无法分析"}
+
+    eps = 1e-10
+    # 数字静音的电平限制在-100dBFS，避免分段平均被拉到极小值
+    rms_db = np.maximum(20 * np.log10(rms + eps), -100.0)
+    silences = silence_segments(rms_db, frame_rate)
+    env = onset_envelope(flux)
+    onsets = pick_onsets(env, frame_rate)
+    bpm, confidence, period = estimate_tempo(env, frame_rate)
+    beats = track_beats(env, period) if period else np.zeros(0, dtype=int)
+    lufs = integrated_loudness(k_power, frame_rate)
+
+    return {
+        "has_audio": True,
+        "sample_rate": sample_rate,
+        "duration": round(duration, 2),
+        "loudness": {
+            "integrated_lufs": round(lufs, 1) if lufs is not None else None,
+            "rms_dbfs": round(max(float(20 * np.log10(np.sqrt(np.mean(rms ** 2)) + eps)), -100.0), 1),
+            "peak_dbfs": round(max(float(20 * np.log10(peak.max() + eps)), -100.0), 1),
+            "energy_profile_dbfs": _energy_profile(rms_db, frame_rate)
+        },
+        "silences": [{"start": s, "end": e} for s, e in silences],
+        "silence_ratio": round(sum(e - s for s, e in silences) / duration, 3) if duration else 0.0,
+        "onsets": len(onsets),
+        "onset_rate": round(len(onsets) / duration, 2) if duration else 0.0,
+        "tempo": {"bpm": bpm, "confidence": confidence},
+        "beats": [round(float(b / frame_rate), 2) for b in beats],
+        "cut_points": cut_points(beats, env, silences, frame_rate)
+    }
+
+
+def analyze_audio(video_path, sample_rate=DEFAULT_SAMPLE_RATE, timeout=None):
+    """
+    分析视频的音轨
+
+    Returns:
+        分析结果字典；缺少numpy/ffmpeg、没有音轨或超时时has_audio为False并带error
+    """
+    started = time.perf_counter()
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return {"has_audio": False, "error": "音频分析需要numpy，请运行: pip install numpy"}
+    try:
+        result = analyze_pcm_chunks(iter_pcm_chunks(video_path, sample_rate, timeout=timeout), sample_rate)
+    except RuntimeError as e:
+        return {"has_audio": False, "error": str(e)}
+    except Exception as e:
+        # 音频只是辅助上下文，任何异常都不能让整个分析失败
+        logging.warning(f"音频分析失败: {video_path}, {e}")
+        return {"has_audio": False, "error": f"音频分析失败: {type(e).__name__}: {e}"}
+    result["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def prompt_context(audio, label=None):
+    """把音频分析结果压缩成给模型的简短说明，没有音频时返回空字符串"""
+    if not audio or not audio.get("has_audio"):
+        return ""
+    loudness = audio["loudness"]
+    if loudness["integrated_lufs"] is None:
+        parts = [f"音轨基本静音，峰值 {loudness['peak_dbfs']} dBFS"]
+    else:
+        parts = [f"整体响度 {loudness['integrated_lufs']} LUFS，峰值 {loudness['peak_dbfs']} dBFS"]
+    profile = loudness.get("energy_profile_dbfs")
+    if profile:
+        parts.append("分段电平(dBFS) " + "/".join(str(v) for v in profile))
+    tempo = audio["tempo"]
+    if tempo["bpm"]:
+        parts.append(f"节奏约 {tempo['bpm']} BPM（置信度 {tempo['confidence']}）")
+    parts.append(f"起音 {audio['onset_rate']} 次/秒")
+    if audio["silences"]:
+        spans = ", ".join(f"{s['start']}-{s['end']}s" for s in audio["silences"][:5])
+        parts.append(f"静音段 {spans}")
+    if audio["cut_points"]:
+        parts.append("节拍对齐的候选剪辑点(秒) " + ", ".join(str(c["time"]) for c in audio["cut_points"][:12]))
+    prefix = f"{label}音频分析" if label else "音频分析"
+    return f"{prefix}（本地计算，可直接用于节奏和音频相关字段）：" + "；".join(parts) + "。"
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stderr)]
+    )
+
+    parser = argparse.ArgumentParser(description='本地音频分析：响度、静音、起音、节拍和剪辑点')
+    parser.add_argument('--video-path', required=True, help='视频或音频文件路径')
+    parser.add_argument('--sample-rate', type=int, default=DEFAULT_SAMPLE_RATE, help='分析采样率')
+    parser.add_argument('--prompt-context', action='store_true', help='只输出给模型的简短上下文')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.video_path):
+        parser.error(f"文件不存在: {args.video_path}")
+    result = analyze_audio(args.video_path, args.sample_rate)
+    if args.prompt_context:
+        print(prompt_context(result))
+    else:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+截断输出续写
+模型输出因max_tokens被截断时（finish_reason为length或JSON括号不平衡），
+先让模型从断点继续输出并拼接；拼接仍无法解析时只请求缺失和被截断的字段再合并，
+避免整段视频重新分析，并记录与完整重跑相比节省的token和时间
+"""
+
+import sys
+import json
+import time
+import argparse
+import logging
+from types import SimpleNamespace
+
+from dashscope_client import response_text
+from model_cascade import parse_model_json, repair_truncated_json
+
+MAX_ROUNDS = 3
+
+# 拼接时检查续写开头与已有输出末尾重复的最大长度
+MAX_OVERLAP = 400
+
+RESUME_PROMPT = ("上面的输出因长度限制被截断。请从截断处继续输出剩余内容，"
+                 "不要重复已经输出的部分，不要添加解释或代码块标记。")
+
+SECTIONS_PROMPT = ("上一次输出因长度限制被截断。请只输出包含以下字段的JSON对象：{keys}。"
+                   "字段的含义和格式与原要求一致，内容尽量精简，不要输出其他字段。")
+
+
+def finish_reason(response):
+    """取出响应的finish_reason（stop/length/null），无法获取时返回None"""
+    try:
+        return response.output.choices[0].finish_reason
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return None
+
+
+def scan_json(text):
+    """
+    扫描JSON文本的括号状态
+
+    Returns:
+        (未闭合的括号数, 是否停在字符串内, 最后一个顶层字段名)；找不到左花括号时返回 (0, False, None)
+    """
+    start = text.find('{') if text else -1
+    if start < 0:
+        return 0, False, None
+
+    depth = 0
+    in_string = False
+    escaped = False
+    string_start = None
+    last_key = None
+    for pos in range(start, len(text)):
+        c = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+                if depth == 1 and text[pos + 1:pos + 32].lstrip().startswith(':'):
+                    last_key = text[string_start + 1:pos]
+            continue
+        if c == '"':
+            in_string = True
+            string_start = pos
+        elif c in '{[':
+            depth += 1
+        elif c in '}]':
+            depth -= 1
+            if depth == 0:
+                return 0, False, last_key
+    return depth, in_string, last_key
+
+
+def is_truncated(text, reason=None):
+    """finish_reason为length，或JSON括号未闭合时视为被截断"""
+    if reason == 'length':
+        return True
+    depth, in_string, _ = scan_json(text)
+    return depth > 0 or in_string
+
+
+def _strip_fences(text):
+    s = text.strip()
+    if s.startswith('```json'):
+        s = s[7:]
+    elif s.startswith('```'):
+        s = s[3:]
+    return s.lstrip('\n')
+
+
+def stitch(partial, continuation):
+    """把续写内容接到截断输出之后，去掉续写开头的代码块标记和与已有末尾重复的部分"""
+    piece = _strip_fences(continuation)
+    for k in range(min(len(partial), len(piece), MAX_OVERLAP), 7, -1):
+        if partial.endswith(piece[:k]):
+            piece = piece[k:]
+            break
+    return partial + piece
+
+
+def _assistant(text):
+    return {"role": "assistant", "content": [{"text": text}]}
+
+
+def _user(text):
+    return {"role": "user", "content": [{"text": text}]}
+
+
+def _usage(response):
+    usage = getattr(response, 'usage', None)
+    return getattr(usage, 'input_tokens', None) or 0, getattr(usage, 'output_tokens', None) or 0
+
+
+def resume_truncated(messages, text, response, call_fn, expected_keys=(), first_latency=None,
+                     max_rounds=MAX_ROUNDS):
+    """
+    补全被截断的模型输出
+
+    Args:
+        messages: 原始请求消息
+        text: 截断的输出文本
+        response: 原始响应，用于读取token用量
+        call_fn: 接收消息列表、返回响应的函数（与原始调用使用相同的模型和参数）
+        expected_keys: 结果应包含的顶层字段，拼接失败时只请求其中缺失的字段
+        first_latency: 原始调用耗时（秒），用于估算完整重跑的时间
+
+    Returns:
+        (data, report)；data为拼接后的对象，完全无法恢复时为None。report["complete"]为False时
+        data只包含截断前已完整输出的字段，节省量字段为None
+    """
+    first_in, first_out = _usage(response)
+    spent_in = spent_out = 0
+    started = time.monotonic()
+    rounds = 0
+    strategy = None
+    data = None
+    current = text
+
+    # 1. 从断点续写：把已有输出作为assistant消息，让模型接着写
+    reason = finish_reason(response)
+    while rounds < max_rounds:
+        rounds += 1
+        resp = call_fn(messages + [_assistant(current), _user(RESUME_PROMPT)])
+        if getattr(resp, 'status_code', 200) != 200:
+            logging.warning(f"续写请求失败: {getattr(resp, 'message', '')}")
+            break
+        tokens_in, tokens_out = _usage(resp)
+        spent_in += tokens_in
+        spent_out += tokens_out
+        current = stitch(current, response_text(resp) or '')
+        reason = finish_reason(resp)
+        if not is_truncated(current, reason):
+            data = parse_model_json(current)
+            if isinstance(data, dict):
+                strategy = 'resume'
+            break
+
+    # 2. 只请求缺失的字段和截断处正在输出的字段
+    if strategy is None:
+        salvaged = repair_truncated_json(current) or {}
+        _, _, open_key = scan_json(current)
+        missing = [k for k in expected_keys if k not in salvaged]
+        if open_key and open_key not in missing and is_truncated(current, reason):
+            missing.append(open_key)
+        if missing:
+            rounds += 1
+            prompt = SECTIONS_PROMPT.format(keys=', '.join(missing))
+            resp = call_fn(messages + [_assistant(text), _user(prompt)])
+            if getattr(resp, 'status_code', 200) == 200:
+                tokens_in, tokens_out = _usage(resp)
+                spent_in += tokens_in
+                spent_out += tokens_out
+                sections = parse_model_json(response_text(resp))
+                if isinstance(sections, dict):
+                    salvaged.update({k: v for k, v in sections.items() if k in missing})
+                    strategy = 'sections'
+        if salvaged:
+            data = salvaged
+            strategy = strategy or 'salvage'
+
+    seconds = time.monotonic() - started
+    complete = strategy in ('resume', 'sections')
+    report = {
+        "truncated": True,
+        "strategy": strategy,
+        "complete": complete,
+        "rounds": rounds,
+        "continuation_input_tokens": spent_in,
+        "continuation_output_tokens": spent_out,
+        "continuation_seconds": round(seconds, 3),
+        "rerun_tokens_estimate": None,
+        "rerun_seconds_estimate": None,
+        "tokens_saved": None,
+        "output_tokens_saved": None,
+        "seconds_saved": None
+    }
+    # 只有得到完整结果时才能与完整重跑比较：结果不完整时完整输出的长度未知，按已输出部分估算会低估重跑成本
+    if complete:
+        # 完整重跑需要重新输出全部内容，耗时按原始调用的输出速度估算
+        total_out = first_out + spent_out
+        rerun_tokens = first_in + total_out
+        rerun_seconds = first_latency * total_out / first_out if first_latency and first_out else None
+        report.update({
+            "rerun_tokens_estimate": rerun_tokens,
+            "rerun_seconds_estimate": round(rerun_seconds, 3) if rerun_seconds is not None else None,
+            "tokens_saved": rerun_tokens - spent_in - spent_out,
+            # 续写每轮都要重新输入视频，节省主要来自不必重新生成已输出的部分
+            "output_tokens_saved": total_out - spent_out,
+            "seconds_saved": round(rerun_seconds - seconds, 3) if rerun_seconds is not None else None
+        })
+    logging.info(f"截断输出续写: 策略={strategy}, 轮数={rounds}, 完整={complete}, 节省token={report['tokens_saved']}")
+    return data, report
+
+
+def _mock_response(text, reason, input_tokens, output_tokens):
+    choice = SimpleNamespace(message=SimpleNamespace(content=[{"text": text}]), finish_reason=reason)
+    return SimpleNamespace(status_code=200, output=SimpleNamespace(choices=[choice]),
+                           usage=SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens))
+
+
+def simulate(items=60, max_chars=4000, input_tokens=8000, chars_per_token=3.0, seconds_per_token=0.02,
+             max_rounds=MAX_ROUNDS):
+    """
+    用按字符截断输出的模拟模型验证续写和拼接
+
+    模拟模型每次最多输出max_chars个字符，续写时从assistant消息的长度处继续输出完整答案，
+    按字段补全时只输出请求的字段
+    """
+    answer = {
+        "duration": 30,
+        "scenes": [{"start": i, "end": i + 1, "description": f"场景{i}的画面描述"} for i in range(items)],
+        "keyframes": [{"timestamp": i * 0.5, "description": f"关键帧{i}"} for i in range(items)],
+        "objects": [{"name": f"物体{i}", "confidence": 0.9} for i in range(items // 2)]
+    }
+    full = json.dumps(answer, ensure_ascii=False)
+
+    def mock_call(messages):
+        last = messages[-1]["content"][0]["text"]
+        target, offset = full, 0
+        if last == RESUME_PROMPT:
+            offset = len(messages[-2]["content"][0]["text"])
+        elif len(messages) > 1:
+            keys = [k for k in answer if k in last.split('：', 1)[-1].split('。')[0].split(', ')]
+            target = json.dumps({k: answer[k] for k in keys}, ensure_ascii=False)
+        piece = target[offset:offset + max_chars]
+        reason = 'length' if offset + max_chars < len(target) else 'stop'
+        prompt_tokens = input_tokens + int(sum(len(m["content"][0].get("text", "")) for m in messages
+                                               if m["role"] == "assistant") / chars_per_token)
+        return _mock_response(piece, reason, prompt_tokens, int(len(piece) / chars_per_token))
+
+    messages = [_user("分析视频")]
+    first = mock_call(messages)
+    first_latency = _usage(first)[1] * seconds_per_token
+    data, report = resume_truncated(messages, response_text(first), first, mock_call,
+                                    expected_keys=list(answer), first_latency=first_latency,
+                                    max_rounds=max_rounds)
+    report["answer_chars"] = len(full)
+    report["matches_full_output"] = data == answer
+    return report
+
+
+def main():
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stderr)]
+    )
+
+    parser = argparse.ArgumentParser(description='截断输出续写')
+    parser.add_argument('--items', type=int, default=60, help='模拟答案中每个列表的条目数')
+    parser.add_argument('--max-chars', type=int, default=4000, help='模拟模型单次最多输出的字符数')
+    parser.add_argument('--max-rounds', type=int, default=MAX_ROUNDS, help='最多续写轮数')
+    args = parser.parse_args()
+
+    print(json.dumps(simulate(args.items, args.max_chars, max_rounds=args.max_rounds), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DashScope 多模态调用层
+两个分析器共用的模型调用入口，支持请求对冲（hedging）：
+主请求在自适应阈值（同等载荷大小历史延迟的p90）内未返回时发出一个重复请求，
+先成功的结果胜出，另一个结果被忽略。对冲比例有上限，延迟和对冲记录保存在SQLite中。
+有截止时间时流式调用能在超时时保留部分输出，但不做对冲；prefer_streaming按剩余时间
+与历史延迟选择两者之一，流式调用的延迟同样写入账本
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import queue
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+import logging
+
+from key_pool import DEFAULT_ACQUIRE_TIMEOUT, classify_response, get_pool, response_tokens
+
+MB = 1024 * 1024
+
+DEFAULT_LEDGER_PATH = os.getenv('DASHSCOPE_LATENCY_DB', os.path.join(tempfile.gettempdir(), 'dashscope_latency.db'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calls (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    model TEXT,
+    bucket INTEGER NOT NULL,
+    latency REAL NOT NULL,
+    success INTEGER NOT NULL,
+    hedged INTEGER NOT NULL,
+    winner TEXT,
+    threshold REAL
+);
+CREATE INDEX IF NOT EXISTS idx_calls_bucket ON calls(model, bucket, ts);
+"""
+
+
+def size_bucket(payload_bytes):
+    """按载荷大小分桶（以MB为单位的log2），延迟分布按桶统计"""
+    return max(0, int(math.log2(max(payload_bytes, 1) / MB + 1)))
+
+
+def percentile(values, q):
+    """线性插值分位数"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+class LatencyLedger:
+    """模型调用延迟账本，跨进程共享以便每次调用都能使用历史分布"""
+
+    def __init__(self, db_path=DEFAULT_LEDGER_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def record(self, model, bucket, latency, success, hedged, winner, threshold):
+        with self._lock:
+            try:
+                with self.conn:
+                    self.conn.execute(
+                        "INSERT INTO calls (ts, model, bucket, latency, success, hedged, winner, threshold) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (time.time(), model, bucket, latency, int(success), int(hedged), winner, threshold)
+                    )
+                    # 只保留最近的记录
+                    self.conn.execute("DELETE FROM calls WHERE id <= (SELECT MAX(id) FROM calls) - 10000")
+            except sqlite3.Error as e:
+                logging.debug(f"记录调用延迟失败: {e}")
+
+    def latencies(self, model, bucket, window=200):
+        """最近成功调用的延迟（对冲调用的延迟不低于其阈值，保留它们可避免阈值逐步下滑）"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT latency FROM calls WHERE model = ? AND bucket = ? AND success = 1 "
+                "ORDER BY id DESC LIMIT ?",
+                (model, bucket, window)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def hedge_rate(self, window=100):
+        with self._lock:
+            rows = self.conn.execute("SELECT hedged FROM calls ORDER BY id DESC LIMIT ?", (window,)).fetchall()
+        return sum(r[0] for r in rows) / len(rows) if rows else 0.0
+
+    def stats(self, model=None):
+        """对冲次数、胜出次数以及延迟分位数"""
+        sql = "SELECT latency, hedged, winner FROM calls WHERE success = 1"
+        params = []
+        if model:
+            sql += " AND model = ?"
+            params.append(model)
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        latencies = [r[0] for r in rows]
+        hedged = sum(1 for r in rows if r[1])
+        return {
+            "calls": len(rows),
+            "hedged": hedged,
+            "hedge_wins": sum(1 for r in rows if r[2] == 'hedge'),
+            "hedge_rate": round(hedged / len(rows), 4) if rows else 0.0,
+            "p50": _round(percentile(latencies, 0.5)),
+            "p90": _round(percentile(latencies, 0.9)),
+            "p99": _round(percentile(latencies, 0.99))
+        }
+
+
+def _round(value, digits=3):
+    return round(value, digits) if value is not None else None
+
+
+class HedgePolicy:
+    """
+    对冲策略
+
+    Args:
+        enabled: 是否启用对冲
+        quantile: 触发对冲的历史延迟分位数
+        max_rate: 最近调用中对冲请求的最大占比
+        min_samples: 历史样本不足时使用default_delay
+        default_delay: 无历史数据时的对冲阈值（秒）
+        min_delay: 阈值下限（秒），避免对极快请求也发出重复调用
+    """
+
+    def __init__(self, enabled=False, quantile=0.9, max_rate=0.1, min_samples=20,
+                 default_delay=60.0, min_delay=2.0):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.getenv('DASHSCOPE_HEDGE', '').lower() in ('1', 'true', 'yes'),
+            quantile=float(os.getenv('DASHSCOPE_HEDGE_QUANTILE', '0.9')),
+            max_rate=float(os.getenv('DASHSCOPE_HEDGE_MAX_RATE', '0.1')),
+            default_delay=float(os.getenv('DASHSCOPE_HEDGE_DEFAULT_DELAY', '60'))
+        )
+
+    def threshold(self, samples):
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, percentile(samples, self.quantile))
+
+
+def _is_success(response):
+    return getattr(response, 'status_code', 200) == 200
+
+
+def response_text(response):
+    """从MultiModalConversation响应中取出文本内容"""
+    try:
+        content = response.output.choices[0].message.content
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return None
+    if isinstance(content, list):
+        content = content[0].get("text", "") if content and isinstance(content[0], dict) else ""
+    elif isinstance(content, dict):
+        content = content.get("text", "")
+    return content if isinstance(content, str) else str(content)
+
+
+def hedged_call(call_fn, policy, ledger=None, model=None, payload_bytes=0, timeout=None):
+    """
+    执行一次可能被对冲的调用
+
+    Args:
+        call_fn: 无参调用函数，返回DashScope响应对象
+        policy: HedgePolicy
+        ledger: LatencyLedger，为None时不使用历史数据也不记录
+        model: 模型名称，用于分组统计
+        payload_bytes: 请求载荷大小，用于延迟分桶
+        timeout: 总等待时间（秒），超时抛出TimeoutError，仍在进行的请求被忽略
+
+    Returns:
+        (response, info)，info包含是否对冲、胜出方、阈值和延迟
+    """
+    bucket = size_bucket(payload_bytes)
+    threshold = None
+    if policy.enabled:
+        samples = ledger.latencies(model, bucket) if ledger else []
+        if ledger is None or ledger.hedge_rate() < policy.max_rate:
+            threshold = policy.threshold(samples)
+
+    results = queue.Queue()
+    started = time.monotonic()
+
+    def run(tag):
+        try:
+            response = call_fn()
+            results.put((tag, response, None))
+        except Exception as e:
+            results.put((tag, None, e))
+
+    # 使用守护线程：落败的请求无法取消，不能让它阻塞进程退出
+    threading.Thread(target=run, args=('primary',), daemon=True).start()
+    pending = 1
+    hedged = False
+    winner = None
+    outcome = None
+    timed_out = False
+
+    while pending:
+        elapsed = time.monotonic() - started
+        waits = []
+        if threshold is not None and not hedged:
+            waits.append(threshold - elapsed)
+        if timeout is not None:
+            waits.append(timeout - elapsed)
+        try:
+            tag, response, error = results.get(timeout=max(min(waits), 0) if waits else None)
+        except queue.Empty:
+            if timeout is not None and time.monotonic() - started >= timeout:
+                timed_out = True
+                break
+            logging.info(f"模型调用超过对冲阈值 {threshold:.1f}秒，发出对冲请求")
+            threading.Thread(target=run, args=('hedge',), daemon=True).start()
+            hedged = True
+            pending += 1
+            continue
+
+        pending -= 1
+        outcome = (response, error)
+        if error is None and _is_success(response):
+            winner = tag
+            break
+        # 主请求在阈值前就失败时直接返回，不把对冲当作重试
+        if not hedged:
+            break
+
+    latency = time.monotonic() - started
+    success = winner is not None
+    if ledger:
+        ledger.record(model, bucket, latency, success, hedged, winner, threshold)
+
+    if timed_out:
+        raise TimeoutError(f"模型调用超过 {timeout:.1f}秒 未返回")
+
+    response, error = outcome
+    info = {
+        "hedged": hedged,
+        "winner": winner,
+        "threshold": _round(threshold),
+        "latency": _round(latency)
+    }
+    if error is not None:
+        raise error
+    return response, info
+
+
+def prefer_streaming(model, payload_bytes, budget, policy=None, ledger=None):
+    """
+    有截止时间时选择调用方式
+
+    剩余时间足够容纳"对冲阈值 + 历史p99延迟"（即对冲请求也能在截止前完成）时使用可对冲的非流式调用，
+    否则使用流式调用，以便截止时间到达时仍能拿到部分输出。未启用对冲或历史样本不足时总是流式调用
+
+    Args:
+        budget: 本次调用可用的秒数，None表示不限时
+    """
+    if budget is None:
+        return False
+    policy = policy or HedgePolicy.from_env()
+    if not policy.enabled:
+        return True
+    ledger = ledger if ledger is not None else get_ledger()
+    samples = ledger.latencies(model, size_bucket(payload_bytes)) if ledger else []
+    if len(samples) < policy.min_samples:
+        return True
+    return budget < policy.threshold(samples) + percentile(samples, 0.99)
+
+
+def stream_multimodal(messages, model, timeout=None, payload_bytes=0, **kwargs):
+    """
+    以流式增量输出调用模型，到达timeout时返回已经收到的文本
+
+    流式调用不做对冲，延迟按载荷大小分桶记入账本，供prefer_streaming和对冲阈值使用
+
+    Returns:
+        (text, finished, last_response, info)；finished为False表示输出被截止时间打断
+    """
+    from dashscope import MultiModalConversation
+
+    pieces = []
+    state = {"response": None, "error": None, "completed": False}
+    done = threading.Event()
+    started = time.monotonic()
+
+    pool = None if 'api_key' in kwargs else get_pool()
+
+    def run():
+        # 与KeyPool.call一致：还没有收到任何输出时被限流，换一个Key重试
+        retries = len(pool.keys) - 1 if pool is not None else 0
+        try:
+            for attempt in range(retries + 1):
+                lease = None
+                response = None
+                if pool is not None:
+                    remaining = timeout - (time.monotonic() - started) if timeout is not None else None
+                    if remaining is not None and remaining <= 0:
+                        break
+                    lease = pool.acquire(timeout=remaining if remaining is not None else DEFAULT_ACQUIRE_TIMEOUT)
+                    kwargs['api_key'] = lease.key
+                try:
+                    for response in MultiModalConversation.call(model=model, messages=messages, stream=True,
+                                                                 incremental_output=True, **kwargs):
+                        state["response"] = response
+                        if not _is_success(response):
+                            break
+                        piece = response_text(response)
+                        if piece:
+                            pieces.append(piece)
+                except Exception:
+                    if lease is not None:
+                        pool.release(lease, 'error')
+                    raise
+                if lease is not None:
+                    outcome = classify_response(response)
+                    pool.release(lease, outcome, response_tokens(response))
+                    if outcome == 'throttled' and not pieces and attempt < retries:
+                        logging.info(f"API Key {lease.key_id} 被限流，换用其他Key重试流式调用")
+                        continue
+                state["completed"] = True
+                break
+        except Exception as e:
+            state["error"] = e
+        finally:
+            done.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    finished = done.wait(timeout)
+    if finished and state["error"] is not None:
+        raise state["error"]
+
+    latency = time.monotonic() - started
+    completed = finished and state["completed"] and _is_success(state["response"])
+    ledger = get_ledger()
+    if ledger:
+        ledger.record(model, size_bucket(payload_bytes), latency, completed, False,
+                      'primary' if completed else None, None)
+    text = "".join(list(pieces))
+    return text, finished and state["completed"], state["response"], {
+        "streamed": True,
+        "timed_out": not finished,
+        "latency": _round(latency)
+    }
+
+
+_ledger = None
+
+
+def get_ledger():
+    """进程内共享的延迟账本，账本不可用时返回None"""
+    global _ledger
+    if _ledger is None:
+        try:
+            _ledger = LatencyLedger()
+        except sqlite3.Error as e:
+            logging.warning(f"延迟账本不可用: {e}")
+            return None
+    return _ledger
+
+
+def call_multimodal(messages, model, payload_bytes=0, policy=None, timeout=None, **kwargs):
+    """
+    调用 MultiModalConversation，按策略决定是否对冲
+
+    未显式传入api_key时从Key池中为每次请求（包括对冲请求）分配负载最低的Key，被限流时换Key重试
+
+    Args:
+        timeout: 最长等待时间（秒），超时抛出TimeoutError
+
+    Returns:
+        (response, info)
+    """
+    from dashscope import MultiModalConversation
+
+    policy = policy or HedgePolicy.from_env()
+    pool = None if 'api_key' in kwargs else get_pool()
+
+    def call_fn():
+        if pool is None:
+            return MultiModalConversation.call(model=model, messages=messages, **kwargs)
+        return pool.call(lambda api_key: MultiModalConversation.call(model=model, messages=messages,
+                                                                     api_key=api_key, **kwargs),
+                         timeout=timeout if timeout is not None else DEFAULT_ACQUIRE_TIMEOUT)
+
+    return hedged_call(call_fn, policy, get_ledger(), model=model, payload_bytes=payload_bytes, timeout=timeout)
+
+
+def heavy_tail_latency(base=1.0, tail_probability=0.1, tail_alpha=1.5):
+    """模拟上游延迟：大部分请求服从对数正态分布，少量请求落入Pareto长尾"""
+    latency = random.lognormvariate(math.log(base), 0.25)
+    if random.random() < tail_probability:
+        latency *= 2 + random.paretovariate(tail_alpha)
+    return latency
+
+
+def simulate(calls=200, time_scale=0.01, **policy_options):
+    """
+    使用长尾延迟的模拟服务对比对冲前后的延迟分位数
+
+    Args:
+        calls: 模拟调用次数
+        time_scale: 延迟缩放比例，1秒模拟延迟实际休眠 time_scale 秒
+    """
+    class MockResponse:
+        status_code = 200
+
+    def mock_call():
+        time.sleep(heavy_tail_latency() * time_scale)
+        return MockResponse()
+
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, enabled in (("baseline", False), ("hedged", True)):
+            ledger = LatencyLedger(os.path.join(tmp, f'{name}.db'))
+            options = dict(policy_options)
+            options.setdefault("min_samples", 20)
+            options.setdefault("default_delay", 3.0)
+            options.setdefault("min_delay", 0.0)
+            policy = HedgePolicy(enabled=enabled, **options)
+            # 阈值按模拟时间缩放
+            policy.default_delay *= time_scale
+            latencies = []
+            for _ in range(calls):
+                _, info = hedged_call(mock_call, policy, ledger, model='mock')
+                latencies.append(info["latency"] / time_scale)
+            stats = ledger.stats()
+            report[name] = {
+                "p50": _round(percentile(latencies, 0.5)),
+                "p90": _round(percentile(latencies, 0.9)),
+                "p99": _round(percentile(latencies, 0.99)),
+                "mean": _round(sum(latencies) / len(latencies)),
+                "hedged": stats["hedged"],
+                "hedge_wins": stats["hedge_wins"]
+            }
+            ledger.conn.close()
+
+    base_p99 = report["baseline"]["p99"]
+    if base_p99:
+        report["p99_improvement"] = round(1 - report["hedged"]["p99"] / base_p99, 3)
+    return report
+
+
+def main():
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stderr)]
+    )
+
+    parser = argparse.ArgumentParser(description='DashScope调用延迟与对冲统计')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_stats = sub.add_parser('stats', help='查看历史调用统计')
+    p_stats.add_argument('--model', help='只统计指定模型')
+    p_sim = sub.add_parser('simulate', help='在长尾延迟模拟服务上对比对冲效果')
+    p_sim.add_argument('--calls', type=int, default=200)
+    p_sim.add_argument('--time-scale', type=float, default=0.01)
+    p_sim.add_argument('--max-rate', type=float, default=0.1)
+    p_sim.add_argument('--quantile', type=float, default=0.9)
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        output = LatencyLedger().stats(args.model)
+    else:
+        output = simulate(args.calls, args.time_scale, max_rate=args.max_rate, quantile=args.quantile)
+    print(json.dumps(output, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分析流水线截止时间
+Node端在固定时间后会终止Python进程，流水线各阶段（下载、探测、编码、模型调用）
+根据剩余时间设置自己的超时，并在时间不足时选择更省时的参数
+"""
+
+import time
+import logging
+
+
+class DeadlineExceeded(Exception):
+    """某个阶段开始或执行时截止时间已到"""
+
+    def __init__(self, stage):
+        super().__init__(f"截止时间已到，阶段: {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """
+    从创建时刻开始计时的时间预算
+
+    Args:
+        seconds: 总预算（秒），None或0表示不限时
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds if seconds and seconds > 0 else None
+        self.started = time.monotonic()
+        self.expires = self.started + self.seconds if self.seconds else None
+        self.stages = []
+
+    @property
+    def enabled(self):
+        return self.expires is not None
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        """剩余秒数，不限时返回None"""
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def budget(self, cap=None, reserve=0.0):
+        """
+        当前阶段可用的超时时间
+
+        Args:
+            cap: 阶段自身的超时上限
+            reserve: 为后续阶段（如输出结果）保留的秒数
+
+        Returns:
+            秒数；不限时且没有cap时返回None
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        available = max(0.0, remaining - reserve)
+        return min(available, cap) if cap is not None else available
+
+    def is_short(self, threshold):
+        """剩余时间是否少于threshold秒"""
+        remaining = self.remaining()
+        return remaining is not None and remaining < threshold
+
+    def check(self, stage):
+        """阶段开始前检查，时间已到时抛出DeadlineExceeded"""
+        if self.expired():
+            raise DeadlineExceeded(stage)
+
+    def mark(self, stage):
+        """记录阶段完成时的耗时，输出到结果中便于排查哪个阶段最慢"""
+        self.stages.append({"stage": stage, "elapsed": round(self.elapsed(), 3)})
+        logging.info(f"阶段完成: {stage}, 已耗时 {self.elapsed():.1f}秒")
+
+    def report(self):
+        return {
+            "deadline_seconds": self.seconds,
+            "elapsed_seconds": round(self.elapsed(), 3),
+            "remaining_seconds": round(self.remaining(), 3) if self.enabled else None,
+            "stages": self.stages
+        }
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享内存解码帧池
+按指定分辨率和抽帧率把视频解码一次，写入 multiprocessing.shared_memory 支持的NumPy数组，
+多个工作进程通过句柄零拷贝读取同一份帧数据；帧池对每个视频做引用计数，
+并按LRU在常驻内存预算内淘汰没有使用者的视频
+
+除按抽帧率均匀解码外，也可以按指定帧号列表解码（稀疏时走seek路径）。
+关键帧缩略图和融合描述子传入FramePool时从帧池读取帧，同一视频、分辨率和帧计划只解码一次
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+from keyframe_extractor import choose_strategy, keyframe_interval, read_frames
+
+MB = 1024 * 1024
+
+DEFAULT_SIZE = (320, 180)
+DEFAULT_SAMPLE_FPS = 2.0
+DEFAULT_BUDGET_MB = int(os.getenv('FRAME_POOL_BUDGET_MB', '512'))
+
+
+class FrameHandle:
+    """可以传给其他进程的帧数据描述（只包含共享内存名称和形状，不包含像素）"""
+
+    def __init__(self, key, shm_name, shape, indices, fps):
+        self.key = key
+        self.shm_name = shm_name
+        self.shape = tuple(shape)
+        self.indices = list(indices)  # 第i个槽位对应的视频帧号
+        self.fps = fps
+
+    @property
+    def timestamps(self):
+        return [round(idx / self.fps, 3) for idx in self.indices]
+
+    @property
+    def nbytes(self):
+        n = 1
+        for d in self.shape:
+            n *= d
+        return n
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "shm_name": self.shm_name,
+            "shape": list(self.shape),
+            "frames": len(self.indices),
+            "fps": self.fps
+        }
+
+
+_attach_lock = threading.Lock()
+
+
+def _open_shared_memory(handle):
+    """
+    以使用方身份附加共享内存，不登记到resource_tracker，生命周期完全由创建方（帧池）管理
+
+    Python 3.13+ 直接使用 track=False。更早的版本附加时也会登记（CPython gh-82300）：使用方有自己的
+    tracker时，退出时会把帧池的共享内存当作泄漏删除；与创建方共用tracker时，事后unregister又会移除
+    创建方自己的登记（集合语义）。因此附加期间临时替换模块级的 resource_tracker.register，
+    只跳过这一块共享内存的登记，效果与 track=False 相同
+    """
+    try:
+        return shared_memory.SharedMemory(name=handle.shm_name, track=False)
+    except TypeError:
+        pass
+
+    register = resource_tracker.register
+
+    def register_except_attached(name, rtype):
+        if rtype == "shared_memory" and name.lstrip('/') == handle.shm_name:
+            return
+        register(name, rtype)
+
+    with _attach_lock:
+        resource_tracker.register = register_except_attached
+        try:
+            return shared_memory.SharedMemory(name=handle.shm_name)
+        finally:
+            resource_tracker.register = register
+
+
+def _unlink_shared_memory(shm):
+    """由创建方关闭并删除共享内存"""
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class AttachedFrames:
+    """
+    在使用方进程中映射帧数据，frames为 (N, H, W, 3) uint8 的只读视图
+
+    用法:
+        with AttachedFrames(handle) as attached:
+            attached.frames.mean()
+
+    不要在with块之外保留frames或其切片，共享内存关闭时不能还有数组引用它
+    """
+
+    def __init__(self, handle):
+        import numpy as np
+
+        self.handle = handle
+        self._shm = _open_shared_memory(handle)
+        self.frames = np.ndarray(handle.shape, dtype=np.uint8, buffer=self._shm.buf)
+        self.frames.flags.writeable = False
+
+    def close(self):
+        # 必须先释放所有引用共享内存缓冲区的数组
+        self.frames = None
+        self._shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextmanager
+def pooled_frames(pool, video_path, size, indices):
+    """
+    从帧池读取指定帧号（必要时解码），yield {帧号: 只读帧视图}；无法解码时yield None
+
+    视图只在with块内有效，需要保留的帧应在块内copy
+    """
+    handle = pool.acquire(video_path, size, indices=indices)
+    if handle is None:
+        yield None
+        return
+    try:
+        with AttachedFrames(handle) as attached:
+            views = {idx: attached.frames[i] for i, idx in enumerate(handle.indices)}
+            try:
+                yield views
+            finally:
+                # 关闭共享内存前释放所有视图
+                views.clear()
+    finally:
+        pool.release(handle)
+
+
+def decode_to_shared_memory(video_path, size=DEFAULT_SIZE, sample_fps=DEFAULT_SAMPLE_FPS, indices=None):
+    """
+    按抽帧率（或指定帧号）解码视频并缩放到指定分辨率，写入新建的共享内存块
+
+    先按帧数分配共享内存，再逐帧读取并直接缩放写入共享数组，任何时候只保留一个全分辨率帧
+
+    Args:
+        indices: 要解码的帧号列表，给出时忽略sample_fps；按帧间距与GOP长度选择顺序解码或seek
+
+    Returns:
+        (SharedMemory, FrameHandle)；无法解码时返回 (None, None)
+    """
+    import cv2
+    import numpy as np
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return None, None
+    shm = None
+    array = None
+    frames = {}
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 0
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        if fps <= 0 or frame_count <= 0:
+            return None, None
+        if indices is None:
+            step = max(1, int(round(fps / sample_fps))) if sample_fps else 1
+            targets = list(range(0, frame_count, step))
+        else:
+            targets = sorted({int(i) for i in indices if 0 <= i < frame_count})
+        if not targets:
+            return None, None
+
+        width, height = size
+        shm = shared_memory.SharedMemory(create=True, size=len(targets) * height * width * 3)
+        array = np.ndarray((len(targets), height, width, 3), dtype=np.uint8, buffer=shm.buf)
+
+        slots = []
+
+        def write_slot(frame):
+            # 读到的帧直接缩放写入下一个槽位，返回槽位号
+            slot = len(slots)
+            cv2.resize(frame, (width, height), dst=array[slot], interpolation=cv2.INTER_AREA)
+            slots.append(slot)
+            return slot
+
+        gop = keyframe_interval(video_path)
+        # 容器声明的帧数可能多于实际可解码的帧数，读不到的目标帧不会出现在结果中
+        frames = read_frames(cv2, cap, targets, choose_strategy(targets, gop), transform=write_slot, gop=gop)
+    except Exception:
+        # 关闭共享内存前必须释放引用其缓冲区的数组
+        array = None
+        if shm is not None:
+            _unlink_shared_memory(shm)
+        raise
+    finally:
+        cap.release()
+    array = None
+
+    if not frames:
+        if shm is not None:
+            _unlink_shared_memory(shm)
+        return None, None
+
+    # 实际解码的帧数可能少于分配的槽位，句柄只暴露已写入的部分
+    shape = (len(frames), height, width, 3)
+
+    key = frame_key(video_path, size, sample_fps, indices)
+    handle = FrameHandle(key, shm.name, shape, sorted(frames, key=frames.get), fps)
+    return shm, handle
+
+
+def frame_key(video_path, size, sample_fps, indices=None):
+    if indices is None:
+        plan = sample_fps
+    else:
+        plan = hashlib.sha1(','.join(str(int(i)) for i in sorted(set(indices))).encode('ascii')).hexdigest()[:16]
+    return f"{os.path.abspath(video_path)}|{size[0]}x{size[1]}|{plan}"
+
+
+class FramePool:
+    """
+    解码帧池（在父进程中使用）
+
+    acquire返回的句柄可以传给任意数量的工作进程，使用完毕后调用release；
+    引用计数为0的视频保留在池中供后续复用，超出内存预算时按最近最少使用顺序淘汰
+    """
+
+    def __init__(self, budget_mb=DEFAULT_BUDGET_MB):
+        self.budget_bytes = int(budget_mb * MB)
+        self._entries = OrderedDict()  # key -> {"shm", "handle", "refs"}
+        self._lock = threading.Lock()
+        self.stats = {"decodes": 0, "hits": 0, "evictions": 0}
+
+    @property
+    def resident_bytes(self):
+        # 按共享内存块的实际大小统计（实际解码的帧数可能少于按帧数分配的槽位）
+        return sum(e["shm"].size for e in self._entries.values())
+
+    def acquire(self, video_path, size=DEFAULT_SIZE, sample_fps=DEFAULT_SAMPLE_FPS, indices=None):
+        """
+        获取视频的帧句柄，必要时解码；无法解码时返回None
+
+        Args:
+            indices: 指定帧号列表时按帧号解码，否则按sample_fps均匀抽帧
+        """
+        key = frame_key(video_path, size, sample_fps, indices)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                entry["refs"] += 1
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry["handle"]
+
+        # 解码不持有锁，其他视频的acquire/release不被阻塞
+        shm, handle = decode_to_shared_memory(video_path, size, sample_fps, indices)
+        if handle is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                # 并发解码了同一个视频，保留先完成的那份
+                _unlink_shared_memory(shm)
+                entry["refs"] += 1
+                return entry["handle"]
+            self._entries[key] = {"shm": shm, "handle": handle, "refs": 1}
+            self.stats["decodes"] += 1
+            self._evict()
+        return handle
+
+    def release(self, handle):
+        with self._lock:
+            entry = self._entries.get(handle.key)
+            if entry and entry["refs"] > 0:
+                entry["refs"] -= 1
+            self._evict()
+
+    def _evict(self):
+        """淘汰无人使用的最久未访问视频，直到常驻内存回到预算内"""
+        for key in list(self._entries):
+            if self.resident_bytes <= self.budget_bytes:
+                break
+            entry = self._entries[key]
+            if entry["refs"] == 0:
+                self._free(key)
+                self.stats["evictions"] += 1
+
+    def _free(self, key):
+        entry = self._entries.pop(key)
+        _unlink_shared_memory(entry["shm"])
+
+    def close(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._free(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# 基准测试使用的示例消费者：亮度统计、运动能量、色彩直方图
+
+def consumer_brightness(frames):
+    return float(frames.mean())
+
+
+def consumer_motion(frames):
+    import numpy as np
+    if len(frames) < 2:
+        return 0.0
+    gray = frames.mean(axis=3, dtype=np.float32)
+    return float(np.abs(np.diff(gray, axis=0)).mean())
+
+
+def consumer_histogram(frames):
+    import numpy as np
+    hist = np.bincount((frames[..., 0] // 32).ravel(), minlength=8)
+    return (hist / hist.sum()).round(4).tolist()
+
+
+CONSUMERS = {
+    "brightness": consumer_brightness,
+    "motion": consumer_motion,
+    "histogram": consumer_histogram
+}
+
+
+def _run_shared(handle, name):
+    with AttachedFrames(handle) as attached:
+        return CONSUMERS[name](attached.frames)
+
+
+def _run_independent(video_path, size, sample_fps, name):
+    shm, handle = decode_to_shared_memory(video_path, size, sample_fps)
+    if handle is None:
+        return None
+    try:
+        with AttachedFrames(handle) as attached:
+            return CONSUMERS[name](attached.frames)
+    finally:
+        _unlink_shared_memory(shm)
+
+
+def benchmark(video_path, consumers=3, size=DEFAULT_SIZE, sample_fps=DEFAULT_SAMPLE_FPS, workers=None):
+    """
+    对比每个消费者各自解码与解码一次共享给所有消费者的耗时
+
+    Args:
+        consumers: 消费者数量（循环使用示例消费者）
+    """
+    names = [list(CONSUMERS)[i % len(CONSUMERS)] for i in range(consumers)]
+    workers = workers or min(consumers, os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # 预热进程池，避免把进程启动时间计入任一方
+        list(pool.map(abs, range(workers)))
+
+        started = time.perf_counter()
+        independent = list(pool.map(_run_independent, [video_path] * consumers, [size] * consumers,
+                                    [sample_fps] * consumers, names))
+        independent_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        with FramePool() as frame_pool:
+            handle = frame_pool.acquire(video_path, size, sample_fps)
+            if handle is None:
+                return {"success": False, "error": f"无法解码视频: {video_path}"}
+            decoded = time.perf_counter()
+            shared = list(pool.map(_run_shared, [handle] * consumers, names))
+            frame_pool.release(handle)
+        shared_seconds = time.perf_counter() - started
+
+    return {
+        "success": independent == shared,
+        "consumers": consumers,
+        "frames": len(handle.timestamps),
+        "frame_bytes_mb": round(handle.nbytes / MB, 2),
+        "independent_seconds": round(independent_seconds, 3),
+        "shared_seconds": round(shared_seconds, 3),
+        "shared_decode_seconds": round(decoded - started, 3),
+        "decodes_avoided": consumers - 1,
+        "speedup": round(independent_seconds / shared_seconds, 2) if shared_seconds else None
+    }
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stderr)]
+    )
+
+    parser = argparse.ArgumentParser(description='共享内存解码帧池')
+    parser.add_argument('--video-path', required=True, help='视频文件路径')
+    parser.add_argument('--consumers', type=int, default=3, help='消费者数量')
+    parser.add_argument('--width', type=int, default=DEFAULT_SIZE[0], help='解码宽度')
+    parser.add_argument('--height', type=int, default=DEFAULT_SIZE[1], help='解码高度')
+    parser.add_argument('--sample-fps', type=float, default=DEFAULT_SAMPLE_FPS, help='抽帧率')
+    parser.add_argument('--workers', type=int, default=None, help='工作进程数')
+    args = parser.parse_args()
+
+    result = benchmark(args.video_path, args.consumers, (args.width, args.height), args.sample_fps, args.workers)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
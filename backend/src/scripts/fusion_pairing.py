@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+融合候选视频本地预排序
+为每个视频计算一次紧凑描述子并缓存（颜色直方图、亮度/对比度、剪辑频率、运动能量、分辨率和帧率），
+用矩阵运算一次性给所有视频对打分，只把得分最高的候选对送给模型做融合分析
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import logging
+from pathlib import Path
+
+from frame_pool import pooled_frames
+from keyframe_extractor import choose_strategy, keyframe_interval, read_frames
+
+DEFAULT_SAMPLES = 24
+ANALYSIS_SIZE = (160, 90)
+HIST_BINS = (16, 4, 4)  # HSV
+CUT_THRESHOLD = 0.5  # 窗口内相邻帧直方图的Bhattacharyya距离
+# 每个采样点读取一个约1秒的短窗口（帧偏移）：第0/1帧用于运动估计，窗口内相邻帧的直方图跳变计为一次剪辑。
+# 剪辑只在短间隔内检测，并按窗口实际覆盖的时长归一化，不随视频长度变化
+WINDOW_OFFSETS = (0, 1, 4, 8, 12, 16, 20, 24, 28)
+DESCRIPTOR_VERSION = 2
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm')
+
+# 各项相似度在总分中的权重
+DEFAULT_WEIGHTS = {
+    "color": 0.35,
+    "tone": 0.2,
+    "pacing": 0.25,
+    "format": 0.2
+}
+
+# 缓存目录固定在backend目录下，Node端可能从任意工作目录启动Python进程
+DEFAULT_CACHE_DIR = os.getenv('FUSION_DESCRIPTOR_CACHE',
+                              str(Path(__file__).resolve().parent.parent.parent / '.cache' / 'fusion_descriptors'))
+
+
+def _cache_key(video_path):
+    st = os.stat(video_path)
+    raw = f"{os.path.abspath(video_path)}|{st.st_size}|{int(st.st_mtime)}|{DEFAULT_SAMPLES}|{DESCRIPTOR_VERSION}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _window_starts(frame_count, samples):
+    """均匀分布、互不重叠的窗口起点；视频短于一个窗口时只取一个从0开始的窗口"""
+    import numpy as np
+
+    span = WINDOW_OFFSETS[-1] + 1
+    n = min(samples, frame_count // span)
+    if n < 1:
+        return [0]
+    return np.unique(np.linspace(0, frame_count - span, num=n).astype(int)).tolist()
+
+
+def compute_descriptor(video_path, samples=DEFAULT_SAMPLES, pool=None):
+    """
+    在均匀分布的短窗口内解码少量帧，计算视频描述子
+
+    窗口稀疏时按GOP长度走seek路径，只解码窗口所在GOP，不必顺序解码整个视频
+
+    Args:
+        pool: FramePool，给出时从帧池按分析尺寸读取窗口帧
+
+    Returns:
+        描述子字典，hist为归一化的HSV直方图（numpy数组），无法读取时返回None
+    """
+    import cv2
+    import numpy as np
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return None
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 0
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH) or 0)
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) or 0)
+        if fps <= 0 or frame_count <= 1:
+            return None
+
+        starts = _window_starts(frame_count, samples)
+        windows = [[p + o for o in WINDOW_OFFSETS if p + o < frame_count] for p in starts]
+        targets = sorted({idx for w in windows for idx in w})
+        if pool is None:
+            gop = keyframe_interval(video_path)
+            # 每帧读到后立即缩小，内存中只保留分析尺寸的帧
+            frames = read_frames(
+                cv2, cap, targets, choose_strategy(targets, gop), gop=gop,
+                transform=lambda f: cv2.resize(f, ANALYSIS_SIZE, interpolation=cv2.INTER_AREA)
+            )
+    finally:
+        cap.release()
+
+    if pool is not None:
+        with pooled_frames(pool, video_path, ANALYSIS_SIZE, targets) as pooled:
+            frames = {idx: frame.copy() for idx, frame in (pooled or {}).items()}
+
+    windows = [[idx for idx in w if idx in frames] for w in windows]
+    order = [idx for w in windows for idx in w]
+    if not order:
+        return None
+    # 同一窗口内相邻帧组成的对（在order中的下标）
+    pairs = []
+    pos = 0
+    for w in windows:
+        pairs.extend((pos + k, pos + k + 1) for k in range(len(w) - 1))
+        pos += len(w)
+
+    small = np.stack([frames[idx] for idx in order])
+
+    hsv = np.stack([cv2.cvtColor(f, cv2.COLOR_BGR2HSV) for f in small])
+    # OpenCV的H范围为0-179，S/V为0-255，按分箱量化后用bincount一次统计所有帧
+    h = (hsv[..., 0].astype(np.int32) * HIST_BINS[0]) // 180
+    s = (hsv[..., 1].astype(np.int32) * HIST_BINS[1]) // 256
+    v = (hsv[..., 2].astype(np.int32) * HIST_BINS[2]) // 256
+    codes = (h * HIST_BINS[1] + s) * HIST_BINS[2] + v
+    n_bins = HIST_BINS[0] * HIST_BINS[1] * HIST_BINS[2]
+    offsets = np.arange(len(order))[:, None, None] * n_bins
+    per_frame = np.bincount((codes + offsets).ravel(), minlength=n_bins * len(order)).reshape(len(order), n_bins)
+    per_frame = per_frame / per_frame.sum(axis=1, keepdims=True)
+
+    gray = small.mean(axis=3)
+
+    cuts = 0
+    sampled_seconds = 0.0
+    motion = 0.0
+    if pairs:
+        a, b = np.array(pairs).T
+        frame_idx = np.array(order)
+        # 窗口内相邻帧的直方图距离超过阈值视为一次剪辑，按这些间隔实际覆盖的时长归一化
+        bc = np.sqrt(per_frame[a] * per_frame[b]).sum(axis=1)
+        cuts = int((np.sqrt(np.clip(1 - bc, 0, None)) > CUT_THRESHOLD).sum())
+        sampled_seconds = float((frame_idx[b] - frame_idx[a]).sum()) / fps
+        # 运动能量只取连续两帧
+        consecutive = frame_idx[b] - frame_idx[a] == 1
+        if consecutive.any():
+            motion = float(np.abs(gray[b[consecutive]] - gray[a[consecutive]]).mean() / 255)
+
+    return {
+        "path": os.path.abspath(video_path),
+        "hist": per_frame.mean(axis=0).astype(np.float32),
+        "brightness": float(gray.mean() / 255),
+        "contrast": float(gray.std(axis=(1, 2)).mean() / 128),
+        "motion": motion,
+        "cut_rate": cuts / sampled_seconds * 60 if sampled_seconds > 0 else 0.0,
+        "width": width,
+        "height": height,
+        "fps": float(fps),
+        "duration": round(frame_count / fps, 2)
+    }
+
+
+def load_descriptor(video_path, cache_dir=DEFAULT_CACHE_DIR, pool=None):
+    """读取缓存的描述子，不存在或文件已变化时重新计算（给出pool时从帧池读取帧）"""
+    import numpy as np
+
+    cache_path = os.path.join(cache_dir, _cache_key(video_path) + '.npz') if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as data:
+                desc = json.loads(str(data["meta"]))
+                desc["hist"] = data["hist"]
+                return desc
+        except (OSError, ValueError, KeyError) as e:
+            logging.debug(f"描述子缓存损坏，重新计算: {cache_path}, {e}")
+
+    desc = compute_descriptor(video_path, pool=pool)
+    if desc and cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        meta = {k: v for k, v in desc.items() if k != "hist"}
+        np.savez(cache_path, hist=desc["hist"], meta=json.dumps(meta))
+    return desc
+
+
+def _ratio_similarity(values, floor=1e-3):
+    """两两比值相似度 exp(-|log(a/b)|)，值越接近得分越高"""
+    import numpy as np
+    logv = np.log(np.maximum(values, floor))
+    return np.exp(-np.abs(logv[:, None] - logv[None, :]))
+
+
+def score_matrix(descriptors, weights=None):
+    """
+    对所有视频对打分
+
+    Returns:
+        (总分矩阵, 各分项矩阵字典)，对角线为 -inf
+    """
+    import numpy as np
+
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+
+    hist = np.stack([d["hist"] for d in descriptors]).astype(np.float64)
+    root = np.sqrt(hist)
+    color = root @ root.T  # Bhattacharyya系数
+
+    brightness = np.array([d["brightness"] for d in descriptors])
+    contrast = np.array([d["contrast"] for d in descriptors])
+    tone = np.exp(-(np.abs(brightness[:, None] - brightness[None, :]) / 0.15
+                    + np.abs(contrast[:, None] - contrast[None, :]) / 0.15) / 2)
+
+    cut_rate = np.array([d["cut_rate"] for d in descriptors])
+    motion = np.array([d["motion"] for d in descriptors])
+    pacing = (_ratio_similarity(cut_rate + 1) + _ratio_similarity(motion, floor=1e-3)) / 2
+
+    width = np.array([d["width"] or 1 for d in descriptors], dtype=np.float64)
+    height = np.array([d["height"] or 1 for d in descriptors], dtype=np.float64)
+    fps = np.array([d["fps"] or 1 for d in descriptors], dtype=np.float64)
+    aspect = _ratio_similarity(width / height)
+    pixels = _ratio_similarity(width * height) ** 0.5
+    # 帧率互为整数倍时转换代价低
+    fps_ratio = np.maximum(fps[:, None], fps[None, :]) / np.minimum(fps[:, None], fps[None, :])
+    fps_score = np.where(np.abs(fps_ratio - np.round(fps_ratio)) < 0.02, 1.0, 0.6)
+    fmt = aspect * pixels * fps_score
+
+    components = {"color": color, "tone": tone, "pacing": pacing, "format": fmt}
+    total = sum(weights[k] * components[k] for k in components)
+    np.fill_diagonal(total, -np.inf)
+    return total, components
+
+
+def top_pairs(descriptors, top_k=5, query_index=None, weights=None):
+    """
+    返回得分最高的候选对
+
+    Args:
+        descriptors: 描述子列表
+        top_k: 返回数量
+        query_index: 指定时只返回与该视频配对的候选，否则返回全库最佳的视频对
+    """
+    import numpy as np
+
+    total, components = score_matrix(descriptors, weights)
+    n = len(descriptors)
+    if query_index is not None:
+        row = total[query_index]
+        k = min(top_k, n - 1)
+        # 对角线为-inf，取最大的k个时不会选中自身
+        idx = np.argpartition(row, n - k)[n - k:] if k > 0 else np.array([], dtype=int)
+        pairs = [(query_index, int(j)) for j in idx[np.argsort(-row[idx])]]
+    else:
+        iu, ju = np.triu_indices(n, k=1)
+        flat = total[iu, ju]
+        k = min(top_k, flat.size)
+        idx = np.argpartition(flat, flat.size - k)[flat.size - k:] if k > 0 else np.array([], dtype=int)
+        idx = idx[np.argsort(-flat[idx])]
+        pairs = [(int(iu[i]), int(ju[i])) for i in idx]
+
+    return [
+        {
+            "video1": descriptors[i]["path"],
+            "video2": descriptors[j]["path"],
+            "score": round(float(total[i, j]), 4),
+            "components": {name: round(float(m[i, j]), 4) for name, m in components.items()}
+        }
+        for i, j in pairs
+    ]
+
+
+def list_videos(directory):
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.splitext(name)[1].lower() in VIDEO_EXTENSIONS
+    )
+
+
+def shortlist(library, query=None, top_k=5, cache_dir=DEFAULT_CACHE_DIR, pool=None):
+    """
+    计算（或读取缓存的）描述子并返回候选对
+
+    Args:
+        library: 视频文件路径列表
+        query: 需要寻找搭档的视频，为None时返回全库最佳视频对
+        top_k: 候选数量
+        pool: FramePool，缓存未命中的描述子从帧池读取帧
+    """
+    started = time.perf_counter()
+    paths = list(library)
+    if query and os.path.abspath(query) not in [os.path.abspath(p) for p in paths]:
+        paths.insert(0, query)
+
+    descriptors = []
+    skipped = []
+    for p in paths:
+        desc = load_descriptor(p, cache_dir, pool)
+        if desc:
+            descriptors.append(desc)
+        else:
+            skipped.append(p)
+    described = time.perf_counter()
+
+    query_index = None
+    if query:
+        query_abs = os.path.abspath(query)
+        query_index = next((i for i, d in enumerate(descriptors) if d["path"] == query_abs), None)
+        if query_index is None:
+            return {"success": False, "error": f"无法读取查询视频: {query}"}
+
+    pairs = top_pairs(descriptors, top_k, query_index) if len(descriptors) > 1 else []
+    return {
+        "success": True,
+        "videos": len(descriptors),
+        "skipped": skipped,
+        "descriptor_seconds": round(described - started, 3),
+        "scoring_seconds": round(time.perf_counter() - described, 3),
+        "candidates": pairs
+    }
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stderr)]
+    )
+
+    parser = argparse.ArgumentParser(description='融合候选视频本地预排序')
+    parser.add_argument('--library', required=True, help='视频库目录')
+    parser.add_argument('--query', help='为该视频寻找融合搭档，不指定时返回全库最佳视频对')
+    parser.add_argument('--top-k', type=int, default=5, help='候选数量')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='描述子缓存目录')
+    args = parser.parse_args()
+
+    result = shortlist(list_videos(args.library), args.query, args.top_k, args.cache_dir)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
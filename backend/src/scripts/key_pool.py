@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DashScope API Key 池
+多个Key分别按令牌桶做请求数（RPM）和token数（TPM）限速，被限流（429/Throttling）后进入冷却，
+连续失败的Key暂时摘除；每个请求分配给健康Key中负载最低的一个。
+所有分析进程通过共享的SQLite账本协调，账本中只保存Key的哈希和掩码，不保存Key本身
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import threading
+import logging
+from types import SimpleNamespace
+
+DEFAULT_DB_PATH = os.getenv('DASHSCOPE_KEY_POOL_DB', os.path.join(tempfile.gettempdir(), 'dashscope_keys.db'))
+
+# 每个Key的限额，0表示不限制该维度
+DEFAULT_RPM = float(os.getenv('DASHSCOPE_KEY_RPM', '0'))
+DEFAULT_TPM = float(os.getenv('DASHSCOPE_KEY_TPM', '0'))
+
+# 令牌桶容量：允许的突发量占一个周期配额的比例（60秒周期时相当于10秒的配额）
+BURST_FRACTION = 1 / 6
+
+# 被限流后的冷却时间（秒），连续限流时翻倍，不超过MAX_COOLDOWN
+DEFAULT_COOLDOWN = 5.0
+MAX_COOLDOWN = 120.0
+
+# 连续失败达到该次数的Key暂时摘除，Key无效时冷却更久
+FAILURE_THRESHOLD = 3
+INVALID_KEY_COOLDOWN = 3600.0
+
+# 租约超过该时间未归还视为进程已退出
+LEASE_TIMEOUT = 600
+
+DEFAULT_ACQUIRE_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS api_keys (
+    key_id TEXT PRIMARY KEY,
+    label TEXT NOT NULL,
+    rpm REAL NOT NULL,
+    tpm REAL NOT NULL,
+    req_tokens REAL NOT NULL,
+    tok_tokens REAL NOT NULL,
+    refilled_at REAL NOT NULL,
+    cooldown_until REAL NOT NULL DEFAULT 0,
+    consecutive_throttles INTEGER NOT NULL DEFAULT 0,
+    consecutive_failures INTEGER NOT NULL DEFAULT 0,
+    requests INTEGER NOT NULL DEFAULT 0,
+    throttles INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    tokens_used INTEGER NOT NULL DEFAULT 0,
+    busy_seconds REAL NOT NULL DEFAULT 0,
+    first_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS key_leases (
+    lease_id TEXT PRIMARY KEY,
+    key_id TEXT NOT NULL,
+    pid INTEGER,
+    estimated_tokens REAL NOT NULL,
+    acquired_at REAL NOT NULL
+);
+"""
+
+
+class KeyPoolExhausted(Exception):
+    """等待超时仍没有可用的Key"""
+
+
+def load_keys():
+    """
+    从环境变量读取Key列表
+
+    DASHSCOPE_API_KEYS 为逗号或空白分隔的多个Key，DASHSCOPE_API_KEY 作为单Key配置继续有效
+    """
+    raw = os.getenv('DASHSCOPE_API_KEYS', '') + ',' + os.getenv('DASHSCOPE_API_KEY', '')
+    keys = []
+    for key in re.split(r'[\s,]+', raw):
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def key_id(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+def mask_key(key):
+    return f"{key[:3]}...{key[-4:]}" if len(key) > 10 else '***'
+
+
+def classify_response(response):
+    """
+    按响应判断Key的状态
+
+    Returns:
+        ok / throttled / invalid / error；请求本身的参数错误不算Key的问题，归为ok
+    """
+    status = getattr(response, 'status_code', 200)
+    code = str(getattr(response, 'code', '') or '')
+    if status == 200:
+        return 'ok'
+    if status == 429 or code.startswith('Throttling'):
+        return 'throttled'
+    if status in (401, 403) or code in ('InvalidApiKey', 'Arrearage'):
+        return 'invalid'
+    if status >= 500:
+        return 'error'
+    return 'ok'
+
+
+def response_tokens(response):
+    usage = getattr(response, 'usage', None)
+    total = 0
+    for name in ('input_tokens', 'output_tokens'):
+        value = getattr(usage, name, None)
+        if isinstance(value, (int, float)):
+            total += value
+    return int(total)
+
+
+class KeyLease:
+    """一次调用占用的Key"""
+
+    def __init__(self, lease_id, key, key_id, estimated_tokens, waited):
+        self.lease_id = lease_id
+        self.key = key
+        self.key_id = key_id
+        self.estimated_tokens = estimated_tokens
+        self.waited = waited
+        self.acquired_at = time.time()
+
+
+class KeyPool:
+    """
+    跨进程共享的API Key池
+
+    Args:
+        keys: Key列表，默认从环境变量读取
+        rpm: 每个Key每个周期的请求数上限，0表示不限
+        tpm: 每个Key每个周期的token数上限，0表示不限
+        period: 限额周期（秒），模拟测试时可以缩短
+    """
+
+    def __init__(self, keys=None, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, db_path=DEFAULT_DB_PATH, period=60.0,
+                 cooldown=DEFAULT_COOLDOWN, poll_interval=0.2):
+        keys = load_keys() if keys is None else list(keys)
+        if not keys:
+            raise ValueError("未配置DASHSCOPE_API_KEY或DASHSCOPE_API_KEYS")
+        self.keys = {key_id(k): k for k in keys}
+        self.rpm = rpm or 0
+        self.tpm = tpm or 0
+        self.db_path = db_path
+        self.period = period
+        self.cooldown = cooldown
+        self.poll_interval = poll_interval
+        self._register()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _capacity(self, limit):
+        return max(1.0, limit * BURST_FRACTION) if limit else 0.0
+
+    def _register(self):
+        now = time.time()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            for kid, key in self.keys.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO api_keys (key_id, label, rpm, tpm, req_tokens, tok_tokens, refilled_at, "
+                    "first_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (kid, mask_key(key), self.rpm, self.tpm, self._capacity(self.rpm), self._capacity(self.tpm),
+                     now, now)
+                )
+                conn.execute("UPDATE api_keys SET rpm = ?, tpm = ? WHERE key_id = ?", (self.rpm, self.tpm, kid))
+
+    def _refill(self, row, now):
+        """按经过的时间补充令牌，返回 (请求令牌, token令牌)"""
+        elapsed = max(0.0, now - row["refilled_at"])
+        req = row["req_tokens"]
+        tok = row["tok_tokens"]
+        if row["rpm"]:
+            req = min(self._capacity(row["rpm"]), req + elapsed * row["rpm"] / self.period)
+        if row["tpm"]:
+            tok = min(self._capacity(row["tpm"]), tok + elapsed * row["tpm"] / self.period)
+        return req, tok
+
+    def _estimate_tokens(self, conn):
+        """没有给出预估时使用历史平均每次调用的token数"""
+        row = conn.execute(
+            "SELECT SUM(tokens_used), SUM(requests) FROM api_keys WHERE key_id IN (%s)"
+            % ','.join('?' * len(self.keys)), list(self.keys)
+        ).fetchone()
+        return row[0] / row[1] if row[1] else 0.0
+
+    def acquire(self, estimated_tokens=None, timeout=DEFAULT_ACQUIRE_TIMEOUT):
+        """
+        为一次调用分配Key，所有Key都在冷却或配额用尽时等待
+
+        Returns:
+            KeyLease
+
+        Raises:
+            KeyPoolExhausted: 等待超时
+        """
+        started = time.time()
+        conn = self._connect()
+        try:
+            while True:
+                now = time.time()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("DELETE FROM key_leases WHERE acquired_at < ?", (now - LEASE_TIMEOUT,))
+                    estimate = estimated_tokens if estimated_tokens is not None else self._estimate_tokens(conn)
+                    rows = conn.execute(
+                        "SELECT k.*, (SELECT COUNT(*) FROM key_leases l WHERE l.key_id = k.key_id) AS in_flight "
+                        "FROM api_keys k WHERE k.key_id IN (%s)" % ','.join('?' * len(self.keys)), list(self.keys)
+                    ).fetchall()
+
+                    best = None
+                    wait = None
+                    for row in rows:
+                        req, tok = self._refill(row, now)
+                        if row["cooldown_until"] > now:
+                            ready_in = row["cooldown_until"] - now
+                        else:
+                            need_tok = min(estimate, self._capacity(row["tpm"])) if row["tpm"] else 0
+                            ready_in = 0.0
+                            if row["rpm"] and req < 1:
+                                ready_in = (1 - req) * self.period / row["rpm"]
+                            if row["tpm"] and tok < need_tok:
+                                ready_in = max(ready_in, (need_tok - tok) * self.period / row["tpm"])
+                        if ready_in > 0:
+                            wait = ready_in if wait is None else min(wait, ready_in)
+                            continue
+                        # 负载：进行中的请求数为主，令牌桶越空负载越高
+                        fill = [req / self._capacity(row["rpm"])] if row["rpm"] else []
+                        if row["tpm"]:
+                            fill.append(tok / self._capacity(row["tpm"]))
+                        load = (row["in_flight"], -min(fill) if fill else 0.0, random.random())
+                        if best is None or load < best[0]:
+                            best = (load, row, req, tok)
+
+                    if best:
+                        _, row, req, tok = best
+                        lease_id = uuid.uuid4().hex
+                        conn.execute(
+                            "UPDATE api_keys SET req_tokens = ?, tok_tokens = ?, refilled_at = ?, "
+                            "requests = requests + 1 WHERE key_id = ?",
+                            (req - 1 if row["rpm"] else req, tok - estimate if row["tpm"] else tok, now, row["key_id"])
+                        )
+                        conn.execute(
+                            "INSERT INTO key_leases (lease_id, key_id, pid, estimated_tokens, acquired_at) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (lease_id, row["key_id"], os.getpid(), estimate, now)
+                        )
+                        conn.execute("COMMIT")
+                        return KeyLease(lease_id, self.keys[row["key_id"]], row["key_id"], estimate, now - started)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+
+                remaining = timeout - (now - started) if timeout is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise KeyPoolExhausted(f"等待可用API Key超时（{timeout}秒）")
+                delay = min(wait if wait is not None else self.poll_interval, 1.0)
+                if remaining is not None:
+                    delay = min(delay, remaining)
+                time.sleep(max(delay, 0.005))
+        finally:
+            conn.close()
+
+    def release(self, lease, outcome='ok', tokens=0):
+        """
+        归还Key并记录结果
+
+        Args:
+            outcome: classify_response 的返回值，或调用抛出异常时的 error
+            tokens: 实际消耗的token数，用于修正令牌桶中的预估值
+        """
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM key_leases WHERE lease_id = ?", (lease.lease_id,))
+                busy = now - lease.acquired_at
+                if outcome == 'throttled':
+                    row = conn.execute("SELECT consecutive_throttles FROM api_keys WHERE key_id = ?",
+                                       (lease.key_id,)).fetchone()
+                    streak = (row["consecutive_throttles"] if row else 0) + 1
+                    cooldown = min(MAX_COOLDOWN, self.cooldown * 2 ** (streak - 1))
+                    conn.execute(
+                        "UPDATE api_keys SET throttles = throttles + 1, consecutive_throttles = ?, "
+                        "cooldown_until = ?, req_tokens = 0, refilled_at = ?, busy_seconds = busy_seconds + ? "
+                        "WHERE key_id = ?",
+                        (streak, now + cooldown, now, busy, lease.key_id)
+                    )
+                    logging.warning(f"API Key {lease.key_id} 被限流，冷却 {cooldown:.0f}秒")
+                elif outcome in ('error', 'invalid'):
+                    row = conn.execute("SELECT consecutive_failures FROM api_keys WHERE key_id = ?",
+                                       (lease.key_id,)).fetchone()
+                    streak = (row["consecutive_failures"] if row else 0) + 1
+                    cooldown_until = 0
+                    if outcome == 'invalid':
+                        cooldown_until = now + INVALID_KEY_COOLDOWN
+                    elif streak >= FAILURE_THRESHOLD:
+                        cooldown_until = now + min(MAX_COOLDOWN, self.cooldown * 2 ** (streak - FAILURE_THRESHOLD))
+                    conn.execute(
+                        "UPDATE api_keys SET failures = failures + 1, consecutive_failures = ?, "
+                        "cooldown_until = MAX(cooldown_until, ?), busy_seconds = busy_seconds + ? WHERE key_id = ?",
+                        (streak, cooldown_until, busy, lease.key_id)
+                    )
+                    if cooldown_until:
+                        logging.warning(f"API Key {lease.key_id} 连续失败 {streak} 次，暂时停用")
+                else:
+                    conn.execute(
+                        "UPDATE api_keys SET consecutive_throttles = 0, consecutive_failures = 0, "
+                        "tokens_used = tokens_used + ?, tok_tokens = tok_tokens - ?, "
+                        "busy_seconds = busy_seconds + ? WHERE key_id = ?",
+                        (tokens, (tokens - lease.estimated_tokens) if tokens else 0, busy, lease.key_id)
+                    )
+        except sqlite3.Error as e:
+            logging.warning(f"归还API Key失败: {e}")
+
+    def call(self, fn, estimated_tokens=None, timeout=DEFAULT_ACQUIRE_TIMEOUT, retries=None):
+        """
+        用池中的Key执行一次调用，被限流时换一个Key重试
+
+        Args:
+            fn: 接收api_key、返回响应的函数
+            retries: 限流后的重试次数，默认 Key数 - 1
+
+        Returns:
+            最后一次调用的响应
+        """
+        retries = len(self.keys) - 1 if retries is None else retries
+        for attempt in range(retries + 1):
+            lease = self.acquire(estimated_tokens, timeout)
+            try:
+                response = fn(lease.key)
+            except Exception:
+                self.release(lease, 'error')
+                raise
+            outcome = classify_response(response)
+            self.release(lease, outcome, response_tokens(response))
+            if outcome != 'throttled' or attempt == retries:
+                return response
+            logging.info(f"API Key {lease.key_id} 被限流，换用其他Key重试")
+
+    def stats(self):
+        """每个Key的利用率、限流和失败次数"""
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT k.*, (SELECT COUNT(*) FROM key_leases l WHERE l.key_id = k.key_id "
+                "AND l.acquired_at >= ?) AS in_flight FROM api_keys k WHERE k.key_id IN (%s) ORDER BY k.first_seen"
+                % ','.join('?' * len(self.keys)), [now - LEASE_TIMEOUT] + list(self.keys)
+            ).fetchall()
+
+        keys = []
+        for r in rows:
+            periods = max(now - r["first_seen"], 1e-9) / self.period
+            req, tok = self._refill(r, now)
+            keys.append({
+                "key_id": r["key_id"],
+                "key": r["label"],
+                "healthy": r["cooldown_until"] <= now,
+                "cooldown_remaining": round(max(0.0, r["cooldown_until"] - now), 1),
+                "in_flight": r["in_flight"],
+                "requests": r["requests"],
+                "throttles": r["throttles"],
+                "failures": r["failures"],
+                "throttle_rate": round(r["throttles"] / r["requests"], 4) if r["requests"] else 0.0,
+                "tokens_used": r["tokens_used"],
+                "rpm": r["rpm"] or None,
+                "tpm": r["tpm"] or None,
+                # 自登记以来平均每周期请求数（token数）占限额的比例
+                "rate_utilization": round(r["requests"] / periods / r["rpm"], 4) if r["rpm"] else None,
+                "token_utilization": round(r["tokens_used"] / periods / r["tpm"], 4) if r["tpm"] else None,
+                "request_bucket": round(req, 2) if r["rpm"] else None,
+                # 平均同时进行中的请求数
+                "avg_in_flight": round(r["busy_seconds"] / (periods * self.period), 4)
+            })
+        return {
+            "keys": keys,
+            "healthy_keys": sum(1 for k in keys if k["healthy"]),
+            "requests": sum(k["requests"] for k in keys),
+            "throttles": sum(k["throttles"] for k in keys)
+        }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """进程内共享的Key池，没有配置Key或账本不可用时返回None"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            keys = load_keys()
+            if not keys:
+                return None
+            try:
+                _pool = KeyPool(keys)
+            except sqlite3.Error as e:
+                logging.warning(f"API Key池账本不可用: {e}")
+                return None
+        return _pool
+
+
+class MockService:
+    """按Key执行令牌桶限额的模拟服务，超出限额返回429"""
+
+    def __init__(self, limits, period=60.0, latency=0.05, tokens=1000):
+        self.limits = limits  # key -> rpm
+        self.period = period
+        self.latency = latency
+        self.tokens = tokens
+        self.buckets = {k: [max(1.0, rpm * BURST_FRACTION), time.monotonic()] for k, rpm in limits.items()}
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+
+    def call(self, api_key):
+        rpm = self.limits[api_key]
+        with self.lock:
+            bucket = self.buckets[api_key]
+            now = time.monotonic()
+            bucket[0] = min(max(1.0, rpm * BURST_FRACTION), bucket[0] + (now - bucket[1]) * rpm / self.period)
+            bucket[1] = now
+            allowed = bucket[0] >= 1
+            if allowed:
+                bucket[0] -= 1
+                self.accepted += 1
+            else:
+                self.rejected += 1
+        if not allowed:
+            return SimpleNamespace(status_code=429, code='Throttling.RateQuota', message='Requests rate limit exceeded')
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        return SimpleNamespace(status_code=200, code='', usage=SimpleNamespace(input_tokens=self.tokens - 200,
+                                                                                output_tokens=200))
+
+
+def simulate(keys=3, rpm=60, requests=150, concurrency=16, period=3.0, weak_key_factor=0.5):
+    """
+    在模拟服务上对比单Key与Key池的吞吐量
+
+    模拟服务对每个Key执行rpm限额（period秒为一个周期），最后一个Key的真实限额只有配置值的
+    weak_key_factor倍，用于验证限流后的冷却和负载转移
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    names = [f"sk-mock-key-{i:04d}" for i in range(keys)]
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, pool_keys in (("single_key", names[:1]), ("pool", names)):
+            limits = {k: rpm for k in pool_keys}
+            if len(pool_keys) > 1:
+                limits[pool_keys[-1]] = rpm * weak_key_factor
+            service = MockService(limits, period=period)
+            pool = KeyPool(pool_keys, rpm=rpm, db_path=os.path.join(tmp, f'{label}.db'), period=period,
+                           cooldown=period / 12)
+
+            def one(_):
+                response = pool.call(service.call, timeout=None)
+                return classify_response(response) == 'ok'
+
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                ok = sum(executor.map(one, range(requests)))
+            elapsed = time.monotonic() - started
+            stats = pool.stats()
+            report[label] = {
+                "succeeded": ok,
+                "elapsed_seconds": round(elapsed, 2),
+                "throughput_per_period": round(ok / elapsed * period, 1),
+                "server_rejections": service.rejected,
+                "keys": [{k: s[k] for k in ("key", "requests", "throttles", "rate_utilization", "avg_in_flight")}
+                         for s in stats["keys"]]
+            }
+
+    single = report["single_key"]["throughput_per_period"]
+    if single:
+        report["throughput_gain"] = round(report["pool"]["throughput_per_period"] / single, 2)
+    return report
+
+
+def main():
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stderr)]
+    )
+
+    parser = argparse.ArgumentParser(description='DashScope API Key池')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_stats = sub.add_parser('stats', help='各Key的利用率和限流统计')
+    p_stats.add_argument('--db', default=DEFAULT_DB_PATH, help='Key池账本数据库路径')
+
+    p_sim = sub.add_parser('simulate', help='在按Key限额的模拟服务上对比单Key与Key池')
+    p_sim.add_argument('--keys', type=int, default=3, help='Key数量')
+    p_sim.add_argument('--rpm', type=float, default=60, help='每个Key每周期的请求数上限')
+    p_sim.add_argument('--requests', type=int, default=150, help='请求总数')
+    p_sim.add_argument('--concurrency', type=int, default=16, help='并发数')
+    p_sim.add_argument('--period', type=float, default=3.0, help='模拟的限额周期（秒）')
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        keys = load_keys()
+        if not keys:
+            parser.error('未配置DASHSCOPE_API_KEY或DASHSCOPE_API_KEYS')
+        output = KeyPool(keys, db_path=args.db).stats()
+    else:
+        output = simulate(args.keys, args.rpm, args.requests, args.concurrency, args.period)
+    print(json.dumps(output, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
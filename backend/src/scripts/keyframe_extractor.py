@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+关键帧缩略图与雪碧图提取
+对模型返回的keyframes时间戳排序后，按目标帧间距与GOP长度选择读取方式：
+目标帧间距小于半个GOP时一次顺序解码，非目标帧只grab不做颜色转换，避免长GOP视频上逐个seek的重复解码；
+目标帧间距更大时逐个seek，只解码目标所在GOP
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from mp4_probe import probe_mp4
+
+DEFAULT_THUMB_WIDTH = 320
+DEFAULT_JPEG_QUALITY = 85
+DEFAULT_SPRITE_COLUMNS = 10
+
+# 无法从stss读取关键帧间隔（非MP4/MOV容器）时假定的GOP长度（帧）
+DEFAULT_KEYFRAME_INTERVAL = 60
+
+
+def timestamps_from_result(result):
+    """从分析结果（完整输出或rawAnalysis）中取出关键帧时间戳"""
+    if isinstance(result.get("data"), dict):
+        result = result["data"].get("rawAnalysis", result["data"])
+    timestamps = []
+    for kf in result.get("keyframes") or []:
+        try:
+            timestamps.append(float(kf.get("timestamp")))
+        except (AttributeError, TypeError, ValueError):
+            continue
+    return timestamps
+
+
+def _resize(cv2, frame, width):
+    h, w = frame.shape[:2]
+    if w <= width:
+        return frame
+    height = max(1, int(round(h * width / w)))
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def _thumb_size(width, height, thumb_width):
+    """与_resize一致的缩略图尺寸 (宽, 高)，无法获取分辨率时返回None"""
+    if width <= 0 or height <= 0:
+        return None
+    if width <= thumb_width:
+        return width, height
+    return thumb_width, max(1, int(round(height * thumb_width / width)))
+
+
+def _plan_targets(timestamps, fps, frame_count):
+    """
+    把时间戳映射为排序去重后的帧号
+
+    Returns:
+        ({帧号: [时间戳...]}, 超出视频范围而被丢弃的时间戳列表)
+    """
+    targets = {}
+    dropped = []
+    last = frame_count - 1 if frame_count and frame_count > 0 else None
+    for t in sorted(timestamps):
+        idx = int(round(t * fps))
+        if idx < 0 or (last is not None and idx > last):
+            dropped.append(t)
+            continue
+        targets.setdefault(idx, []).append(t)
+    return targets, dropped
+
+
+def read_frames_single_pass(cap, targets, transform=None):
+    """
+    一次顺序解码读取所有目标帧
+
+    Args:
+        transform: 对每个读到的帧立即执行的函数（如缩小），避免同时保留多个全分辨率帧
+    """
+    frames = {}
+    pos = 0
+    for idx in sorted(targets):
+        # grab只解复用和解码压缩数据，不做颜色转换和拷贝
+        while pos <= idx:
+            if not cap.grab():
+                return frames
+            pos += 1
+        ok, frame = cap.retrieve()
+        if ok:
+            frames[idx] = transform(frame) if transform else frame
+    return frames
+
+
+def _read_with_seek(cv2, cap, targets, transform=None, near=0):
+    """
+    逐个目标帧seek读取，适合稀疏的目标帧
+
+    Args:
+        near: 下一个目标帧在当前位置之后不超过该帧数时顺序grab过去，不重新seek
+    """
+    frames = {}
+    pos = None  # 下一次read将返回的帧号，None表示需要seek
+    for idx in sorted(targets):
+        if pos is None or not 0 <= idx - pos <= near:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            pos = idx
+        while pos < idx and cap.grab():
+            pos += 1
+        ok, frame = cap.read() if pos == idx else (False, None)
+        if ok:
+            frames[idx] = transform(frame) if transform else frame
+            pos += 1
+        else:
+            pos = None
+    return frames
+
+
+def keyframe_interval(video_path):
+    """从MP4/MOV的stss读取平均关键帧间隔（帧），无法读取时返回None"""
+    meta = probe_mp4(video_path)
+    return meta.get("keyframe_interval") if meta else None
+
+
+def choose_strategy(targets, gop=None):
+    """
+    按目标帧间距与GOP长度选择读取方式
+
+    顺序解码要解码到最后一个目标帧为止；seek方式下相距不到半个GOP的目标帧顺序grab，
+    更远的目标帧seek后平均要从上一个关键帧解码约半个GOP。比较两者需要解码的总帧数，
+    均匀分布的目标帧即间距超过半个GOP时seek
+
+    Args:
+        targets: 目标帧号（_plan_targets的结果或帧号列表）
+        gop: 平均关键帧间隔（帧），None时使用DEFAULT_KEYFRAME_INTERVAL
+    """
+    if not targets:
+        return 'single_pass'
+    half_gop = (gop or DEFAULT_KEYFRAME_INTERVAL) / 2
+    ordered = sorted(targets)
+    seek_cost = 0
+    prev = -1
+    for idx in ordered:
+        seek_cost += min(idx - prev, half_gop)
+        prev = idx
+    return 'seek' if seek_cost < ordered[-1] + 1 else 'single_pass'
+
+
+def read_frames(cv2, cap, targets, strategy, transform=None, gop=None):
+    """
+    按choose_strategy选出的方式读取目标帧，返回 {帧号: 帧}
+
+    seek方式下相距不到半个GOP的目标帧顺序grab，成簇的目标帧只seek一次
+    """
+    if strategy == 'seek':
+        return _read_with_seek(cv2, cap, targets, transform, near=int((gop or DEFAULT_KEYFRAME_INTERVAL) / 2))
+    return read_frames_single_pass(cap, targets, transform)
+
+
+def build_sprite(tiles, columns):
+    """把等宽缩略图拼成雪碧图，返回(图像, 单元宽, 单元高, 行数)"""
+    import numpy as np
+
+    tile_w = max(t.shape[1] for t in tiles)
+    tile_h = max(t.shape[0] for t in tiles)
+    columns = max(1, min(columns, len(tiles)))
+    rows = (len(tiles) + columns - 1) // columns
+
+    sprite = np.zeros((rows * tile_h, columns * tile_w, 3), dtype=np.uint8)
+    for i, tile in enumerate(tiles):
+        y = (i // columns) * tile_h
+        x = (i % columns) * tile_w
+        sprite[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+    return sprite, tile_w, tile_h, rows
+
+
+def extract_keyframes(video_path, timestamps, output_dir, thumb_width=DEFAULT_THUMB_WIDTH,
+                      jpeg_quality=DEFAULT_JPEG_QUALITY, sprite_columns=DEFAULT_SPRITE_COLUMNS,
+                      strategy='auto', pool=None):
+    """
+    提取关键帧缩略图、雪碧图和索引JSON
+
+    Args:
+        video_path: 视频文件路径
+        timestamps: 关键帧时间戳列表（秒），无需排序
+        output_dir: 输出目录
+        thumb_width: 缩略图宽度，高度按比例缩放
+        jpeg_quality: JPEG质量（1-100）
+        sprite_columns: 雪碧图每行的缩略图数量
+        strategy: auto 按目标帧间距与GOP长度选择 / single_pass 顺序解码 / seek 逐个定位
+        pool: FramePool，给出时从帧池按缩略图尺寸读取目标帧，忽略strategy
+
+    Returns:
+        结果字典，包含缩略图列表、雪碧图和索引文件路径
+    """
+    try:
+        import cv2
+    except ImportError:
+        return {"success": False, "error": "OpenCV未安装，请运行: pip install opencv-python"}
+
+    started = time.perf_counter()
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return {"success": False, "error": f"OpenCV无法打开视频文件: {video_path}"}
+
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 0
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        if fps <= 0:
+            return {"success": False, "error": "无法获取视频帧率"}
+
+        targets, dropped = _plan_targets(timestamps, fps, frame_count)
+        if pool is not None:
+            strategy = 'pool'
+            size = _thumb_size(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH) or 0),
+                               int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) or 0), thumb_width)
+        else:
+            gop = keyframe_interval(video_path)
+            if strategy == 'auto':
+                strategy = choose_strategy(targets, gop)
+            frames = read_frames(cv2, cap, targets, strategy, gop=gop)
+    finally:
+        cap.release()
+
+    if pool is not None:
+        from frame_pool import pooled_frames
+
+        frames = {}
+        if targets and size:
+            with pooled_frames(pool, video_path, size, list(targets)) as pooled:
+                frames = {idx: frame.copy() for idx, frame in (pooled or {}).items()}
+
+    os.makedirs(output_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(video_path))[0]
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), int(jpeg_quality)]
+
+    thumbnails = []
+    tiles = []
+    for idx in sorted(frames):
+        tile = _resize(cv2, frames[idx], thumb_width)
+        file_name = f"{stem}_{idx:06d}.jpg"
+        cv2.imwrite(os.path.join(output_dir, file_name), tile, params)
+        for t in targets[idx]:
+            thumbnails.append({
+                "timestamp": t,
+                "frame": idx,
+                "file": file_name,
+                "tile": len(tiles)
+            })
+        tiles.append(tile)
+
+    index = {
+        "video": os.path.basename(video_path),
+        "fps": fps,
+        "sprite": None,
+        "frames": thumbnails
+    }
+    if tiles:
+        sprite, tile_w, tile_h, rows = build_sprite(tiles, sprite_columns)
+        sprite_name = f"{stem}_sprite.jpg"
+        cv2.imwrite(os.path.join(output_dir, sprite_name), sprite, params)
+        columns = max(1, min(sprite_columns, len(tiles)))
+        index.update({
+            "sprite": sprite_name,
+            "tile_width": tile_w,
+            "tile_height": tile_h,
+            "columns": columns,
+            "rows": rows
+        })
+        for item in thumbnails:
+            item["x"] = (item["tile"] % columns) * tile_w
+            item["y"] = (item["tile"] // columns) * tile_h
+
+    index_path = os.path.join(output_dir, f"{stem}_index.json")
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2, ensure_ascii=False)
+
+    if dropped:
+        logging.warning(f"{len(dropped)} 个时间戳超出视频范围 {dropped}: {video_path}")
+    missing = len(timestamps) - len(dropped) - len(thumbnails)
+    if missing:
+        logging.warning(f"{missing} 个时间戳解码失败，未能提取: {video_path}")
+
+    return {
+        "success": True,
+        "video_path": video_path,
+        "strategy": strategy,
+        "fps": fps,
+        "frame_count": frame_count,
+        "requested": len(timestamps),
+        "extracted": len(thumbnails),
+        "out_of_range": dropped,
+        "thumbnails": [os.path.join(output_dir, t["file"]) for t in thumbnails],
+        "sprite": os.path.join(output_dir, index["sprite"]) if index["sprite"] else None,
+        "index": index_path,
+        "elapsed_seconds": round(time.perf_counter() - started, 3)
+    }
+
+
+def extract_batch(jobs, workers=None, **options):
+    """
+    使用进程池并行处理多个视频
+
+    Args:
+        jobs: [{"video_path": ..., "timestamps": [...], "output_dir": ...}, ...]
+        workers: 进程数，默认CPU核数
+
+    Returns:
+        与jobs顺序一致的结果列表
+    """
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(extract_keyframes, job["video_path"], job["timestamps"], job["output_dir"], **options): i
+            for i, job in enumerate(jobs)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                results[i] = {"success": False, "video_path": jobs[i]["video_path"], "error": str(e)}
+    return results
+
+
+def benchmark(video_path, timestamps, output_dir):
+    """对比顺序解码与逐个seek的耗时"""
+    single = extract_keyframes(video_path, timestamps, os.path.join(output_dir, 'single_pass'),
+                               strategy='single_pass')
+    seek = extract_keyframes(video_path, timestamps, os.path.join(output_dir, 'seek'), strategy='seek')
+    if not single.get("success") or not seek.get("success"):
+        return {"success": False, "single_pass": single, "seek": seek}
+    targets, _ = _plan_targets(timestamps, single["fps"], single["frame_count"])
+    gop = keyframe_interval(video_path)
+    return {
+        "success": True,
+        "timestamps": len(timestamps),
+        "single_pass_seconds": single["elapsed_seconds"],
+        "seek_seconds": seek["elapsed_seconds"],
+        "keyframe_interval": gop,
+        "auto_strategy": choose_strategy(targets, gop),
+        "speedup": round(seek["elapsed_seconds"] / single["elapsed_seconds"], 2) if single["elapsed_seconds"] else None
+    }
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stderr)]
+    )
+
+    parser = argparse.ArgumentParser(description='关键帧缩略图与雪碧图提取')
+    parser.add_argument('--video-path', help='视频文件路径')
+    parser.add_argument('--result', help='video_analyzer输出的JSON文件，从中读取keyframes时间戳')
+    parser.add_argument('--timestamps', help='逗号分隔的时间戳（秒）')
+    parser.add_argument('--batch', help='批量任务JSON: [{"video_path", "timestamps"|"result", "output_dir"}]')
+    parser.add_argument('--output-dir', default='thumbnails', help='输出目录')
+    parser.add_argument('--width', type=int, default=DEFAULT_THUMB_WIDTH, help='缩略图宽度')
+    parser.add_argument('--quality', type=int, default=DEFAULT_JPEG_QUALITY, help='JPEG质量')
+    parser.add_argument('--columns', type=int, default=DEFAULT_SPRITE_COLUMNS, help='雪碧图列数')
+    parser.add_argument('--workers', type=int, default=None, help='批量模式的进程数')
+    parser.add_argument('--benchmark', action='store_true', help='与逐个seek方式对比耗时')
+    args = parser.parse_args()
+
+    options = {"thumb_width": args.width, "jpeg_quality": args.quality, "sprite_columns": args.columns}
+
+    if args.batch:
+        with open(args.batch, 'r', encoding='utf-8') as f:
+            jobs = json.load(f)
+        for job in jobs:
+            if "timestamps" not in job:
+                with open(job["result"], 'r', encoding='utf-8') as rf:
+                    job["timestamps"] = timestamps_from_result(json.load(rf))
+            job.setdefault("output_dir", args.output_dir)
+        started = time.perf_counter()
+        results = extract_batch(jobs, args.workers, **options)
+        output = {
+            "success": all(r.get("success") for r in results),
+            "videos": len(results),
+            "elapsed_seconds": round(time.perf_counter() - started, 3),
+            "results": results
+        }
+    else:
+        if not args.video_path:
+            parser.error('需要 --video-path 或 --batch')
+        if args.timestamps:
+            timestamps = [float(t) for t in args.timestamps.split(',') if t.strip()]
+        elif args.result:
+            with open(args.result, 'r', encoding='utf-8') as f:
+                timestamps = timestamps_from_result(json.load(f))
+        else:
+            parser.error('需要 --timestamps 或 --result')
+
+        if args.benchmark:
+            output = benchmark(args.video_path, timestamps, args.output_dir)
+        else:
+            output = extract_keyframes(args.video_path, timestamps, args.output_dir, **options)
+
+    print(json.dumps(output, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
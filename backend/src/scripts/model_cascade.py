@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分级模型级联
+先用更便宜、更快的VL模型（或更低的抽帧率）做第一轮分析，结果通过完整性和置信度检查即采用；
+只有未通过检查的任务才升级到重量级模型。模型名称来自配置，升级率和节省的延迟记录在账本中
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import logging
+
+from dashscope_client import DEFAULT_LEDGER_PATH, LatencyLedger, percentile
+from deadline import DeadlineExceeded
+
+DEFAULT_MODEL = 'qwen3-vl-plus'
+DEFAULT_FAST_MODEL = 'qwen3-vl-flash'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cascade_runs (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    analysis_type TEXT,
+    final_stage TEXT,
+    final_model TEXT,
+    escalated INTEGER NOT NULL,
+    attempts TEXT NOT NULL
+);
+"""
+
+# 各分析类型通过检查所需的字段，列表类字段要求非空
+REQUIRED_FIELDS = {
+    "content": {"keys": ["scenes", "keyframes", "objects"], "non_empty": ["scenes", "keyframes"]},
+    "fusion": {"keys": ["fusion_potential", "recommended_structure"], "non_empty": ["recommended_structure"]}
+}
+
+
+def _env_flag(name):
+    return os.getenv(name, '').lower() in ('1', 'true', 'yes')
+
+
+def default_model():
+    """重量级模型名称，可通过DASHSCOPE_MODEL覆盖"""
+    return os.getenv('DASHSCOPE_MODEL', DEFAULT_MODEL)
+
+
+def load_cascade_stages(default_fps=2.0):
+    """
+    从环境变量读取级联配置
+
+    DASHSCOPE_CASCADE_STAGES 可以是JSON数组，例如
+    [{"name": "fast", "model": "qwen3-vl-flash", "fps": 1}, {"name": "full", "model": "qwen3-vl-plus"}]；
+    否则 DASHSCOPE_CASCADE=true 时使用 DASHSCOPE_FAST_MODEL/DASHSCOPE_FAST_FPS 作为第一级，
+    未启用级联时只有重量级模型一级
+    """
+    raw = os.getenv('DASHSCOPE_CASCADE_STAGES')
+    if raw:
+        try:
+            stages = json.loads(raw)
+            for i, stage in enumerate(stages):
+                stage.setdefault("name", f"stage{i + 1}")
+                stage.setdefault("model", default_model())
+                stage.setdefault("fps", default_fps)
+            if stages:
+                return stages
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.warning(f"DASHSCOPE_CASCADE_STAGES 配置无效，已忽略: {e}")
+
+    full = {"name": "full", "model": default_model(), "fps": default_fps}
+    if not _env_flag('DASHSCOPE_CASCADE'):
+        return [full]
+    fast = {
+        "name": "fast",
+        "model": os.getenv('DASHSCOPE_FAST_MODEL', DEFAULT_FAST_MODEL),
+        "fps": float(os.getenv('DASHSCOPE_FAST_FPS', str(min(default_fps, 1.0))))
+    }
+    return [fast, full]
+
+
+def apply_stage_fps(messages, fps):
+    """
+    返回替换了视频抽帧率的消息副本
+
+    所有视频项（包括未指定fps的Base64 data URL）都设置fps，否则低抽帧率的第一级与重量级阶段发送的是同一请求
+    """
+    if fps is None:
+        return messages
+    staged = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = [dict(item, fps=fps) if isinstance(item, dict) and "video" in item else item
+                       for item in content]
+            message = dict(message, content=content)
+        staged.append(message)
+    return staged
+
+
+def parse_model_json(text):
+    """解析模型输出的JSON，兼容markdown代码块和前后的说明文字"""
+    if not text:
+        return None
+    s = text.strip()
+    if s.startswith('```json'):
+        s = s[7:]
+    elif s.startswith('```'):
+        s = s[3:]
+    if s.endswith('```'):
+        s = s[:-3]
+    s = s.strip()
+    try:
+        return json.loads(s)
+    except ValueError:
+        m = re.search(r'\{[\s\S]*\}', s)
+        if m:
+            try:
+                return json.loads(m.group(0))
+            except ValueError:
+                return None
+    return None
+
+
+def repair_truncated_json(text):
+    """
+    从被截断的JSON输出中恢复尽可能多的内容
+
+    在最后一个完整值（逗号或右括号）处截断，并补齐尚未闭合的括号
+
+    Returns:
+        解析出的对象，无法恢复时返回None
+    """
+    if not text:
+        return None
+    start = text.find('{')
+    if start < 0:
+        return None
+
+    closers = []
+    in_string = False
+    escaped = False
+    checkpoints = []
+    for pos in range(start, len(text)):
+        c = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+            continue
+        if c == '"':
+            in_string = True
+        elif c in '{[':
+            closers.append('}' if c == '{' else ']')
+        elif c in '}]':
+            if closers:
+                closers.pop()
+            if not closers:
+                # 顶层对象已经完整
+                checkpoints.append((pos + 1, ''))
+                break
+            checkpoints.append((pos + 1, ''.join(reversed(closers))))
+        elif c == ',':
+            checkpoints.append((pos, ''.join(reversed(closers))))
+
+    for cut, suffix in reversed(checkpoints[-50:]):
+        try:
+            data = json.loads(text[start:cut] + suffix)
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            return data
+    return None
+
+
+def validate_result(data, analysis_type="content", min_confidence=None):
+    """
+    检查一轮分析结果是否可以直接采用
+
+    Returns:
+        (是否通过, 未通过原因列表)
+    """
+    if min_confidence is None:
+        min_confidence = float(os.getenv('DASHSCOPE_CASCADE_MIN_CONFIDENCE', '0.5'))
+
+    if not isinstance(data, dict) or data.get("error"):
+        return False, ["invalid_json"]
+
+    rules = REQUIRED_FIELDS.get(analysis_type, REQUIRED_FIELDS["content"])
+    reasons = []
+    for key in rules["keys"]:
+        if key not in data:
+            reasons.append(f"missing:{key}")
+    for key in rules["non_empty"]:
+        if key in data and not data.get(key):
+            reasons.append(f"empty:{key}")
+
+    if analysis_type == "content":
+        confidences = []
+        for obj in data.get("objects") or []:
+            try:
+                confidences.append(float(obj.get("confidence")))
+            except (AttributeError, TypeError, ValueError):
+                continue
+        if confidences and sum(confidences) / len(confidences) < min_confidence:
+            reasons.append("low_confidence")
+
+    return not reasons, reasons
+
+
+def run_cascade(stages, call_stage, evaluate, deadline=None):
+    """
+    按顺序执行级联，返回第一个通过检查的结果（最后一级的结果总是被采用）
+
+    Args:
+        stages: load_cascade_stages 返回的阶段列表
+        call_stage: 接收阶段字典、返回该阶段结果的函数
+        evaluate: 接收阶段结果、返回 (是否通过, 原因列表) 的函数
+        deadline: Deadline，剩余时间不够再跑一级时停止升级，采用当前结果
+
+    Returns:
+        (result, info)，info记录最终阶段、是否升级以及每一级的耗时和检查结果
+
+    Raises:
+        最后一级的异常；或上一级出错后因截止时间停止升级时，上一级的异常
+    """
+    attempts = []
+    result = None
+    error = None
+    for i, stage in enumerate(stages):
+        # 按上一级的耗时估算下一级所需时间
+        if attempts and deadline is not None and deadline.is_short(attempts[-1]["latency"] * 1.5):
+            logging.warning(f"剩余时间不足，停止升级到阶段 {stage['name']}")
+            attempts[-1]["reasons"].append("deadline_stop")
+            break
+        started = time.monotonic()
+        try:
+            result = call_stage(stage)
+            ok, reasons = evaluate(result)
+        except (TimeoutError, DeadlineExceeded):
+            raise
+        except Exception as e:
+            if i == len(stages) - 1:
+                raise
+            result, ok, reasons, error = None, False, [f"error:{type(e).__name__}"], e
+        attempts.append({
+            "stage": stage["name"],
+            "model": stage["model"],
+            "fps": stage.get("fps"),
+            "latency": round(time.monotonic() - started, 3),
+            "accepted": ok,
+            "reasons": reasons
+        })
+        if ok:
+            break
+        if i < len(stages) - 1:
+            logging.info(f"级联阶段 {stage['name']}({stage['model']}) 未通过检查 {reasons}，升级到下一阶段")
+
+    if result is None and error is not None:
+        # 上一级出错后因截止时间停止升级，没有可用结果，交给调用方按错误处理
+        raise error
+
+    final = attempts[-1]
+    info = {
+        "stage": final["stage"],
+        "model": final["model"],
+        "escalated": len(attempts) > 1,
+        "attempts": attempts
+    }
+    return result, info
+
+
+class CascadeLedger:
+    """级联运行记录，与调用延迟账本共用同一个数据库文件"""
+
+    def __init__(self, db_path=DEFAULT_LEDGER_PATH):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=10)
+        self.conn.executescript(SCHEMA)
+
+    def record(self, analysis_type, info):
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO cascade_runs (ts, analysis_type, final_stage, final_model, escalated, attempts) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (time.time(), analysis_type, info["stage"], info["model"], int(info["escalated"]),
+                     json.dumps(info["attempts"], ensure_ascii=False))
+                )
+        except sqlite3.Error as e:
+            logging.debug(f"记录级联结果失败: {e}")
+
+    def stats(self, heavy_model=None):
+        """
+        升级率与节省的延迟
+
+        节省的延迟按 "重量级模型的中位延迟 - 第一级实际延迟" 累加到未升级的任务上，
+        升级任务在第一级花费的时间计为额外开销
+        """
+        heavy_model = heavy_model or default_model()
+        rows = self.conn.execute("SELECT escalated, attempts FROM cascade_runs").fetchall()
+        runs = [(bool(r[0]), json.loads(r[1])) for r in rows]
+        cascaded = [(esc, att) for esc, att in runs if len(att) > 1 or att[0]["model"] != heavy_model]
+
+        heavy_latencies = [a["latency"] for _, att in runs for a in att if a["model"] == heavy_model]
+        if not heavy_latencies:
+            heavy_latencies = LatencyLedger(self.db_path).latencies(heavy_model, 0, window=500)
+        heavy_p50 = percentile(heavy_latencies, 0.5)
+
+        saved = 0.0
+        overhead = 0.0
+        for escalated, attempts in cascaded:
+            if escalated:
+                overhead += sum(a["latency"] for a in attempts[:-1])
+            elif heavy_p50 is not None:
+                saved += heavy_p50 - attempts[0]["latency"]
+
+        escalations = sum(1 for esc, _ in cascaded if esc)
+        return {
+            "runs": len(runs),
+            "cascaded_runs": len(cascaded),
+            "escalations": escalations,
+            "escalation_rate": round(escalations / len(cascaded), 4) if cascaded else 0.0,
+            "heavy_model": heavy_model,
+            "heavy_p50_latency": round(heavy_p50, 3) if heavy_p50 is not None else None,
+            "latency_saved_seconds": round(saved, 3),
+            "escalation_overhead_seconds": round(overhead, 3),
+            "net_saved_seconds": round(saved - overhead, 3)
+        }
+
+
+def record_cascade(analysis_type, info):
+    """记录一次级联运行，账本不可用时忽略"""
+    try:
+        ledger = CascadeLedger()
+        ledger.record(analysis_type, info)
+        ledger.conn.close()
+    except sqlite3.Error as e:
+        logging.debug(f"级联账本不可用: {e}")
+
+
+def main():
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stderr)]
+    )
+
+    parser = argparse.ArgumentParser(description='模型级联统计')
+    parser.add_argument('--db', default=DEFAULT_LEDGER_PATH, help='账本数据库路径')
+    parser.add_argument('--heavy-model', default=None, help='重量级模型名称')
+    args = parser.parse_args()
+
+    print(json.dumps(CascadeLedger(args.db).stats(args.heavy_model), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MP4/MOV 头部解析器
+通过内存映射遍历 ISO-BMFF box 树（moov/mvhd/tkhd/mdhd/stts/stss/stsd），
+只读取头部字节即可获得时长、分辨率、帧率、帧数、关键帧间隔和编码格式，无需启动子进程或解码器
+"""
+
+import os
+import mmap
+import json
+import time
+import struct
+import argparse
+import logging
+
+# 支持头部解析的扩展名，其余容器交给ffprobe处理
+MP4_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.3gp')
+
+
+def iter_boxes(buf, start, end):
+    """遍历[start, end)区间内的box，产出(type, payload_start, box_end)"""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', buf, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size = struct.unpack_from('>Q', buf, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            # box声明的长度超出文件范围，通常是截断的文件
+            return
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def find_box(buf, start, end, box_type):
+    """在区间内查找第一个指定类型的box"""
+    for t, payload, box_end in iter_boxes(buf, start, end):
+        if t == box_type:
+            return payload, box_end
+    return None
+
+
+def _parse_time_header(buf, payload):
+    """解析mvhd/mdhd共有的 timescale/duration 字段"""
+    version = buf[payload]
+    if version == 1:
+        timescale, duration = struct.unpack_from('>IQ', buf, payload + 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', buf, payload + 12)
+    return timescale, duration
+
+
+def _parse_tkhd(buf, payload):
+    """解析tkhd中的显示宽高（16.16定点数）"""
+    version = buf[payload]
+    offset = payload + (88 if version == 1 else 76)
+    width, height = struct.unpack_from('>II', buf, offset)
+    return width >> 16, height >> 16
+
+
+def _parse_hdlr(buf, payload):
+    """解析hdlr中的handler类型（vide/soun/...）"""
+    return struct.unpack_from('>4s', buf, payload + 8)[0]
+
+
+def _parse_stsd(buf, payload):
+    """解析stsd第一个sample entry的编码格式和编码尺寸"""
+    entry_count = struct.unpack_from('>I', buf, payload + 4)[0]
+    if entry_count == 0:
+        return None, None, None
+    entry = payload + 8
+    codec = struct.unpack_from('>4s', buf, entry + 4)[0]
+    # VisualSampleEntry: 8字节box头 + 6字节保留 + 2字节索引 + 16字节预定义
+    width, height = struct.unpack_from('>HH', buf, entry + 32)
+    return codec.decode('latin-1').strip(), width, height
+
+
+def _parse_stts(buf, payload):
+    """解析stts，返回(总样本数, 总时长刻度)"""
+    entry_count = struct.unpack_from('>I', buf, payload + 4)[0]
+    frames = 0
+    ticks = 0
+    offset = payload + 8
+    for _ in range(entry_count):
+        count, delta = struct.unpack_from('>II', buf, offset)
+        frames += count
+        ticks += count * delta
+        offset += 8
+    return frames, ticks
+
+
+def _parse_stss(buf, payload):
+    """解析stss，返回同步样本（关键帧）数量"""
+    return struct.unpack_from('>I', buf, payload + 4)[0]
+
+
+def _parse_trak(buf, start, end):
+    """解析单个trak，返回轨道信息字典"""
+    track = {"handler": None}
+
+    tkhd = find_box(buf, start, end, b'tkhd')
+    if tkhd:
+        track["width"], track["height"] = _parse_tkhd(buf, tkhd[0])
+
+    mdia = find_box(buf, start, end, b'mdia')
+    if not mdia:
+        return track
+
+    hdlr = find_box(buf, mdia[0], mdia[1], b'hdlr')
+    if hdlr:
+        track["handler"] = _parse_hdlr(buf, hdlr[0])
+
+    mdhd = find_box(buf, mdia[0], mdia[1], b'mdhd')
+    if mdhd:
+        track["timescale"], track["duration"] = _parse_time_header(buf, mdhd[0])
+
+    minf = find_box(buf, mdia[0], mdia[1], b'minf')
+    stbl = find_box(buf, minf[0], minf[1], b'stbl') if minf else None
+    if stbl:
+        stsd = find_box(buf, stbl[0], stbl[1], b'stsd')
+        if stsd:
+            track["codec"], track["coded_width"], track["coded_height"] = _parse_stsd(buf, stsd[0])
+        stts = find_box(buf, stbl[0], stbl[1], b'stts')
+        if stts:
+            track["frames"], track["ticks"] = _parse_stts(buf, stts[0])
+        stss = find_box(buf, stbl[0], stbl[1], b'stss')
+        # 没有stss表示每个样本都是同步样本（全帧内编码）
+        track["sync_samples"] = _parse_stss(buf, stss[0]) if stss else None
+
+    return track
+
+
+def probe_mp4(video_path):
+    """
+    解析MP4/MOV文件头部获取元数据
+
+    Returns:
+        成功时返回包含 duration/frameRate/width/height/frames/keyframe_interval/codec/moov_offset 的字典，
+        不是ISO-BMFF文件或缺少moov时返回None
+    """
+    try:
+        with open(video_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < 8:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return _probe_buffer(buf)
+    except (OSError, ValueError, struct.error) as e:
+        logging.debug(f"MP4头部解析失败: {video_path}, {e}")
+        return None
+
+
+def _probe_buffer(buf):
+    """在已映射的缓冲区上解析元数据"""
+    size = len(buf)
+    top = {}
+    # 顶层box首尾相接，box起始偏移即上一个box的结束位置（头部可能是8或16字节，不能由payload反推）
+    box_start = 0
+    for box_type, payload, box_end in iter_boxes(buf, 0, size):
+        if box_type in (b'ftyp', b'moov', b'mdat') and box_type not in top:
+            top[box_type] = (payload, box_end, box_start)
+        box_start = box_end
+
+    if b'ftyp' not in top and b'moov' not in top:
+        return None
+
+    moov = top.get(b'moov')
+    if not moov:
+        return None
+
+    meta = {
+        "duration": 0,
+        "frameRate": None,
+        "width": None,
+        "height": None,
+        "frames": None,
+        "keyframe_interval": None,
+        "codec": None,
+        "moov_offset": moov[2],
+        "mdat_offset": top[b'mdat'][2] if b'mdat' in top else None
+    }
+
+    mvhd = find_box(buf, moov[0], moov[1], b'mvhd')
+    if mvhd:
+        timescale, duration = _parse_time_header(buf, mvhd[0])
+        if timescale:
+            meta["duration"] = round(duration / timescale, 2)
+
+    for box_type, payload, box_end in iter_boxes(buf, moov[0], moov[1]):
+        if box_type != b'trak':
+            continue
+        track = _parse_trak(buf, payload, box_end)
+        if track.get("handler") != b'vide':
+            continue
+
+        meta["codec"] = track.get("codec")
+        meta["width"] = track.get("width") or track.get("coded_width") or None
+        meta["height"] = track.get("height") or track.get("coded_height") or None
+        meta["frames"] = track.get("frames") or None
+        if meta["frames"]:
+            # 平均关键帧间隔（帧），即平均GOP长度
+            sync = track.get("sync_samples")
+            if sync is None:
+                meta["keyframe_interval"] = 1.0
+            elif sync > 0:
+                meta["keyframe_interval"] = round(meta["frames"] / sync, 2)
+
+        timescale = track.get("timescale")
+        if timescale and track.get("frames") and track.get("ticks"):
+            meta["frameRate"] = round(track["frames"] * timescale / track["ticks"], 3)
+        if not meta["duration"] and timescale and track.get("duration"):
+            meta["duration"] = round(track["duration"] / timescale, 2)
+        break
+
+    return meta
+
+
+def is_mp4_family(video_path):
+    """判断文件扩展名是否属于可以头部解析的容器"""
+    return os.path.splitext(video_path)[1].lower() in MP4_EXTENSIONS
+
+
+def scan_layout(video_path):
+    """
+    读取顶层box头部，检查文件结构是否完整
+
+    与iter_boxes不同，遇到声明长度超出文件末尾的box时不静默停止，而是记录缺失的字节数；
+    box头本身无效（长度小于头部、类型不是可打印字符）时记为malformed，而不是截断。
+    只读取每个box的头部，与文件大小无关
+
+    Returns:
+        {"boxes", "file_size", "truncated", "missing_bytes", "malformed", "malformed_offset", "has_moov",
+         "moov_complete", "moov_offset", "mdat_offset", "faststart"}，不是ISO-BMFF文件时返回None
+    """
+    boxes = []
+    missing = 0
+    malformed_offset = None
+    with open(video_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            size, box_type = struct.unpack_from('>I4s', header, 0)
+            header_size = 8
+            if size == 1:
+                if len(header) < 16:
+                    missing = 16 - len(header)
+                    break
+                size = struct.unpack_from('>Q', header, 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = file_size - offset
+            if size < header_size or not all(32 <= c < 127 for c in box_type):
+                # box头无效，之后的内容无法继续解析
+                malformed_offset = offset
+                break
+            boxes.append({
+                "type": box_type.decode('latin-1'),
+                "offset": offset,
+                "size": size
+            })
+            if offset + size > file_size:
+                missing = offset + size - file_size
+                break
+            offset += size
+        else:
+            if 0 < file_size - offset < 8:
+                # 末尾残留不足一个box头
+                missing = 8 - (file_size - offset)
+
+    if not boxes or boxes[0]["type"] not in ('ftyp', 'moov', 'mdat', 'free', 'skip', 'wide'):
+        return None
+
+    offsets = {}
+    for box in boxes:
+        offsets.setdefault(box["type"], box["offset"])
+    moov_offset = offsets.get('moov')
+    mdat_offset = offsets.get('mdat')
+    moov = next((b for b in boxes if b["type"] == 'moov'), None)
+    return {
+        "boxes": boxes,
+        "file_size": file_size,
+        "truncated": missing > 0,
+        "missing_bytes": missing,
+        "malformed": malformed_offset is not None,
+        "malformed_offset": malformed_offset,
+        "has_moov": moov_offset is not None,
+        "moov_complete": moov is not None and moov["offset"] + moov["size"] <= file_size,
+        "moov_offset": moov_offset,
+        "mdat_offset": mdat_offset,
+        # moov位于mdat之前时播放器无需读到文件末尾即可开始播放
+        "faststart": moov_offset is not None and (mdat_offset is None or moov_offset < mdat_offset)
+    }
+
+
+def benchmark(paths, repeat=3):
+    """对比头部解析与read_video_meta完整流程的耗时"""
+    from video_analyzer import read_video_meta
+
+    results = {"files": len(paths), "repeat": repeat}
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for p in paths:
+            probe_mp4(p)
+    header_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for p in paths:
+            read_video_meta(p, use_header_parser=False)
+    legacy_seconds = time.perf_counter() - start
+
+    calls = max(len(paths) * repeat, 1)
+    results["header_parser_ms_per_file"] = round(header_seconds / calls * 1000, 3)
+    results["read_video_meta_ms_per_file"] = round(legacy_seconds / calls * 1000, 3)
+    results["speedup"] = round(legacy_seconds / header_seconds, 1) if header_seconds > 0 else None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MP4/MOV头部元数据解析')
+    parser.add_argument('path', help='视频文件或目录路径')
+    parser.add_argument('--benchmark', action='store_true', help='与read_video_meta对比耗时')
+    parser.add_argument('--repeat', type=int, default=3, help='基准测试重复次数')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.path):
+        paths = [os.path.join(args.path, n) for n in sorted(os.listdir(args.path))]
+        paths = [p for p in paths if os.path.isfile(p) and is_mp4_family(p)]
+    else:
+        paths = [args.path]
+
+    if args.benchmark:
+        output = benchmark(paths, args.repeat)
+    else:
+        output = {os.path.basename(p): probe_mp4(p) for p in paths}
+
+    print(json.dumps(output, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
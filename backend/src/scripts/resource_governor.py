@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内存感知的分析任务准入控制
+每个分析进程启动前根据文件大小和上传方式估算峰值内存，通过共享的SQLite账本
+统计所有在运行任务的预估内存，只有总量低于预算时才放行；
+超出预算的任务改走低内存的file://方式或排队等待，并记录实际RSS峰值用于校准估算
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import argparse
+import tempfile
+import threading
+import logging
+
+MB = 1024 * 1024
+
+# 小于该大小的文件使用Base64内联上传
+BASE64_LIMIT = 10 * MB
+
+# 解释器 + DashScope SDK + 依赖的常驻内存
+BASELINE_BYTES = 120 * MB
+
+# Base64内联上传时同一份数据的副本数（相对原始文件大小）：
+# 原始bytes 1份，b64encode结果与decode后的str各4/3份，data URL的f-string 4/3份，SDK序列化请求体 4/3份
+BASE64_COPY_FACTOR = 1 + 4 / 3 * 4
+
+# OpenCV解码器缓存的帧数（YUV420，每帧 w*h*1.5 字节）
+DECODER_BUFFER_FRAMES = 16
+DEFAULT_DECODE_RESOLUTION = (1920, 1080)
+
+# 心跳超过该时间未更新的任务视为已退出（进程被杀死时不会主动释放）
+HEARTBEAT_TIMEOUT = 30
+
+DEFAULT_BUDGET_MB = int(os.getenv('MEMORY_BUDGET_MB', '2048'))
+DEFAULT_DB_PATH = os.getenv('ADMISSION_DB', os.path.join(tempfile.gettempdir(), 'video_analyzer_admission.db'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    pid INTEGER,
+    status TEXT NOT NULL,
+    mode TEXT,
+    estimated_bytes INTEGER NOT NULL,
+    current_rss INTEGER,
+    peak_rss INTEGER,
+    queued_at REAL NOT NULL,
+    admitted_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, queued_at);
+"""
+
+
+class AdmissionTimeout(Exception):
+    """等待超时仍无法获得内存预算"""
+
+
+def _windows_memory_info():
+    """
+    通过 GetProcessMemoryInfo 读取当前进程的工作集，返回 (当前, 峰值) 字节数
+
+    Windows上没有/proc和resource模块，未安装psutil时使用该方式；调用失败时返回None
+    """
+    try:
+        import ctypes
+        from ctypes import wintypes
+    except ImportError:
+        return None
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    try:
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        # Windows 7及以上kernel32导出K32GetProcessMemoryInfo，无需加载psapi.dll
+        get_info = kernel32.K32GetProcessMemoryInfo
+        get_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+        get_info.restype = wintypes.BOOL
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if not get_info(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return None
+        return counters.WorkingSetSize, counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        return None
+
+
+def current_rss():
+    """当前进程常驻内存（字节），无法获取时返回None"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform == 'win32':
+        info = _windows_memory_info()
+        return info[0] if info else None
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """当前进程的RSS峰值（字节），无法获取时返回None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux单位为KB，macOS为字节
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    except ImportError:
+        pass
+    if sys.platform == 'win32':
+        info = _windows_memory_info()
+        return info[1] if info else None
+    return None
+
+
+def choose_upload_mode(file_size):
+    """与分析器一致的上传方式选择：小文件Base64内联，大文件file://"""
+    return 'base64' if file_size < BASE64_LIMIT else 'file'
+
+
+def estimate_job_memory(file_sizes, mode=None, decode=False, resolution=None):
+    """
+    估算单个分析任务的峰值内存
+
+    Args:
+        file_sizes: 参与分析的视频文件大小列表（融合分析为两个）
+        mode: 强制上传方式 base64/file，None表示按文件大小自动选择
+        decode: 是否会打开OpenCV解码器
+        resolution: 解码分辨率 (width, height)
+
+    Returns:
+        预估峰值字节数
+    """
+    total = BASELINE_BYTES
+    for size in file_sizes:
+        file_mode = mode or choose_upload_mode(size)
+        if file_mode == 'base64':
+            total += int(size * BASE64_COPY_FACTOR)
+        if decode:
+            w, h = resolution or DEFAULT_DECODE_RESOLUTION
+            total += int(w * h * 1.5 * DECODER_BUFFER_FRAMES)
+    return total
+
+
+class Admission:
+    """一次准入许可，负责心跳、RSS采样和释放"""
+
+    def __init__(self, governor, job_id, mode, estimated_bytes, degraded, wait_seconds):
+        self.governor = governor
+        self.job_id = job_id
+        self.mode = mode
+        self.estimated_bytes = estimated_bytes
+        self.degraded = degraded
+        self.wait_seconds = wait_seconds
+        self.max_sampled_rss = current_rss() or 0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.governor.sample_interval):
+            self.governor.heartbeat(self.job_id, self._sample())
+
+    def _sample(self):
+        rss = current_rss()
+        if rss:
+            self.max_sampled_rss = max(self.max_sampled_rss, rss)
+        return rss
+
+    def actual_peak(self):
+        peak = peak_rss()
+        return max(peak or 0, self.max_sampled_rss) or None
+
+    def release(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._sampler.join(timeout=1)
+        self.governor.finish(self.job_id, self._sample(), self.actual_peak())
+
+    def report(self):
+        """估算值与实际峰值对比，附加到分析结果中"""
+        peak = self.actual_peak()
+        rss = current_rss()
+        return {
+            "job_id": self.job_id,
+            "mode": self.mode,
+            "degraded": self.degraded,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "estimated_peak_mb": round(self.estimated_bytes / MB, 1),
+            "actual_peak_mb": round(peak / MB, 1) if peak else None,
+            "current_rss_mb": round(rss / MB, 1) if rss else None,
+            "estimate_ratio": round(peak / self.estimated_bytes, 3) if peak else None
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class ResourceGovernor:
+    """跨进程内存预算管理，账本保存在SQLite中以兼容Windows与Linux"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, budget_mb=DEFAULT_BUDGET_MB,
+                 poll_interval=0.5, sample_interval=1.0):
+        self.db_path = db_path
+        self.budget_bytes = int(budget_mb * MB)
+        self.poll_interval = poll_interval
+        self.sample_interval = sample_interval
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _prune(self, conn, now):
+        """回收心跳超时的任务，清理一天前的历史记录"""
+        conn.execute(
+            "UPDATE jobs SET status = 'lost', finished_at = ? "
+            "WHERE status IN ('running', 'queued') AND heartbeat_at < ?",
+            (now, now - HEARTBEAT_TIMEOUT)
+        )
+        conn.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (now - 86400,))
+
+    def admit(self, file_sizes, decode=False, resolution=None, allow_degrade=True,
+              timeout=120, job_id=None, mode=None):
+        """
+        申请执行一个分析任务
+
+        Args:
+            file_sizes: 视频文件大小列表
+            decode: 是否会打开OpenCV解码器
+            resolution: 解码分辨率
+            allow_degrade: 预算不足时是否允许改用file://上传
+            timeout: 最长排队时间（秒）
+            job_id: 任务标识，默认随机生成
+            mode: 调用方固定使用的上传方式（base64/file），None表示按文件大小自动选择
+
+        Returns:
+            Admission 许可对象，mode 为最终采用的上传方式（auto/file，或调用方指定的方式）
+
+        Raises:
+            AdmissionTimeout: 排队超时
+        """
+        job_id = job_id or uuid.uuid4().hex
+        preferred = estimate_job_memory(file_sizes, mode=mode, decode=decode, resolution=resolution)
+        fallback = estimate_job_memory(file_sizes, mode='file', decode=decode, resolution=resolution)
+        started = time.time()
+        queued = False
+
+        conn = self._connect()
+        try:
+            while True:
+                now = time.time()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._prune(conn, now)
+                    used = conn.execute(
+                        "SELECT COALESCE(SUM(estimated_bytes), 0) FROM jobs WHERE status = 'running'"
+                    ).fetchone()[0]
+                    # 先到先得：前面还有排队任务时不插队
+                    ahead = conn.execute(
+                        "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND queued_at < ? AND job_id != ?",
+                        (started, job_id)
+                    ).fetchone()[0]
+
+                    decision = None
+                    if not ahead and used + preferred <= self.budget_bytes:
+                        decision = (mode or 'auto', preferred, False)
+                    elif not ahead and allow_degrade and fallback < preferred and used + fallback <= self.budget_bytes:
+                        decision = ('file', fallback, True)
+                    # 账本为空时总是放行，避免单个超预算任务永远无法执行
+                    elif not ahead and used == 0:
+                        decision = ('file' if allow_degrade else mode or 'auto',
+                                    fallback if allow_degrade else preferred,
+                                    allow_degrade and fallback < preferred)
+
+                    if decision:
+                        mode, estimated, degraded = decision
+                        conn.execute(
+                            "INSERT OR REPLACE INTO jobs (job_id, pid, status, mode, estimated_bytes, queued_at, "
+                            "admitted_at, heartbeat_at) VALUES (?, ?, 'running', ?, ?, ?, ?, ?)",
+                            (job_id, os.getpid(), mode, estimated, started, now, now)
+                        )
+                        conn.execute("COMMIT")
+                        if degraded:
+                            logging.info(f"内存预算不足，任务 {job_id} 改用file://方式（预估 {estimated / MB:.1f}MB）")
+                        return Admission(self, job_id, mode, estimated, degraded, now - started)
+
+                    if not queued:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO jobs (job_id, pid, status, estimated_bytes, queued_at, "
+                            "heartbeat_at) VALUES (?, ?, 'queued', ?, ?, ?)",
+                            (job_id, os.getpid(), preferred, started, now)
+                        )
+                        queued = True
+                        logging.info(f"内存预算不足，任务 {job_id} 进入排队（已用 {used / MB:.1f}MB / "
+                                     f"预算 {self.budget_bytes / MB:.0f}MB）")
+                    else:
+                        conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?", (now, job_id))
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+
+                if now - started >= timeout:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'timeout', finished_at = ? WHERE job_id = ?", (now, job_id)
+                    )
+                    raise AdmissionTimeout(f"等待内存预算超时（{timeout}秒）")
+                time.sleep(self.poll_interval)
+        finally:
+            conn.close()
+
+    def heartbeat(self, job_id, rss):
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE jobs SET heartbeat_at = ?, current_rss = ?, "
+                    "peak_rss = MAX(COALESCE(peak_rss, 0), COALESCE(?, 0)) WHERE job_id = ?",
+                    (time.time(), rss, rss, job_id)
+                )
+        except sqlite3.Error as e:
+            logging.debug(f"更新任务心跳失败: {e}")
+
+    def finish(self, job_id, rss, peak):
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE jobs SET status = 'done', finished_at = ?, current_rss = ?, "
+                    "peak_rss = MAX(COALESCE(peak_rss, 0), COALESCE(?, 0)) WHERE job_id = ?",
+                    (time.time(), rss, peak, job_id)
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"释放任务内存预算失败: {e}")
+
+    def status(self, include_finished=False):
+        """返回账本中的任务列表及预算使用情况"""
+        with self._connect() as conn:
+            self._prune(conn, time.time())
+            sql = "SELECT * FROM jobs"
+            if not include_finished:
+                sql += " WHERE status IN ('running', 'queued')"
+            rows = conn.execute(sql + " ORDER BY queued_at").fetchall()
+
+        jobs = []
+        for r in rows:
+            jobs.append({
+                "job_id": r["job_id"],
+                "pid": r["pid"],
+                "status": r["status"],
+                "mode": r["mode"],
+                "estimated_peak_mb": round(r["estimated_bytes"] / MB, 1),
+                "current_rss_mb": round(r["current_rss"] / MB, 1) if r["current_rss"] else None,
+                "actual_peak_mb": round(r["peak_rss"] / MB, 1) if r["peak_rss"] else None,
+                "estimate_ratio": round(r["peak_rss"] / r["estimated_bytes"], 3) if r["peak_rss"] else None
+            })
+        running = [j for j in jobs if j["status"] == "running"]
+        return {
+            "budget_mb": round(self.budget_bytes / MB, 1),
+            "reserved_mb": round(sum(j["estimated_peak_mb"] for j in running), 1),
+            "running": len(running),
+            "queued": sum(1 for j in jobs if j["status"] == "queued"),
+            "jobs": jobs
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分析任务内存准入状态')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help='准入账本数据库路径')
+    parser.add_argument('--budget-mb', type=float, default=DEFAULT_BUDGET_MB, help='内存预算（MB）')
+    parser.add_argument('--all', action='store_true', help='包含已结束的任务')
+    args = parser.parse_args()
+
+    governor = ResourceGovernor(args.db, args.budget_mb)
+    print(json.dumps(governor.status(include_finished=args.all), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分析结果时间线索引
+将build_result输出的keyframes/scenes/objects/actions写入SQLite，
+支持按视频、时间区间、物体名称和全文检索查询整个视频库，无需重新调用模型
+"""
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import logging
+from pathlib import Path
+
+# 数据库固定在backend目录下，Node端可能从任意工作目录启动Python进程
+DEFAULT_DB_PATH = os.getenv('TIMELINE_INDEX_DB',
+                            str(Path(__file__).resolve().parent.parent.parent / 'timeline_index.db'))
+
+# FTS5 trigram无法检索少于3个字符的关键词，这类关键词通过名称的单字/双字词表精确匹配
+SHORT_TERM_LENGTH = 2
+
+SEGMENT_KINDS = ('keyframe', 'scene', 'object', 'action')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    video_key TEXT NOT NULL UNIQUE,
+    duration REAL,
+    resolution TEXT,
+    frame_rate REAL,
+    analyzed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    video_id INTEGER NOT NULL REFERENCES videos(id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    label TEXT,
+    text TEXT,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    confidence REAL,
+    payload TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_segments_kind_label ON segments(kind, label, start_time);
+CREATE INDEX IF NOT EXISTS idx_segments_video_time ON segments(video_id, start_time, end_time);
+CREATE INDEX IF NOT EXISTS idx_segments_time ON segments(start_time, end_time);
+CREATE TABLE IF NOT EXISTS segment_terms (
+    term TEXT NOT NULL,
+    segment_id INTEGER NOT NULL REFERENCES segments(id) ON DELETE CASCADE,
+    PRIMARY KEY (term, segment_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_segment_terms_segment ON segment_terms(segment_id);
+"""
+
+
+def _to_float(value, default=None):
+    """模型返回的时间戳可能是字符串或缺失，统一转换为浮点数"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def label_terms(label):
+    """名称中所有长度不超过SHORT_TERM_LENGTH的子串（小写），用于短关键词检索"""
+    if not label:
+        return set()
+    label = str(label).strip().lower()
+    return {label[i:i + n] for n in range(1, SHORT_TERM_LENGTH + 1) for i in range(len(label) - n + 1)}
+
+
+def extract_segments(result):
+    """把build_result的输出展开为统一的时间线片段列表"""
+    segments = []
+
+    for kf in result.get("keyframes") or []:
+        if not isinstance(kf, dict):
+            continue
+        t = _to_float(kf.get("timestamp"), 0.0)
+        segments.append({
+            "kind": "keyframe",
+            "label": kf.get("importance"),
+            "text": kf.get("description"),
+            "start_time": t,
+            "end_time": t,
+            "confidence": None,
+            "payload": kf
+        })
+
+    for scene in result.get("scenes") or []:
+        if not isinstance(scene, dict):
+            continue
+        start = _to_float(scene.get("startTime"), 0.0)
+        segments.append({
+            "kind": "scene",
+            "label": scene.get("type"),
+            "text": " ".join(str(scene.get(k)) for k in ("description", "atmosphere") if scene.get(k)),
+            "start_time": start,
+            "end_time": _to_float(scene.get("endTime"), start),
+            "confidence": None,
+            "payload": scene
+        })
+
+    for obj in result.get("objects") or []:
+        if not isinstance(obj, dict):
+            continue
+        start = _to_float(obj.get("first_seen"), 0.0)
+        segments.append({
+            "kind": "object",
+            "label": obj.get("name"),
+            "text": obj.get("name"),
+            "start_time": start,
+            "end_time": start + _to_float(obj.get("duration"), 0.0),
+            "confidence": _to_float(obj.get("confidence")),
+            "payload": obj
+        })
+
+    for action in result.get("actions") or []:
+        if not isinstance(action, dict):
+            continue
+        start = _to_float(action.get("startTime"), 0.0)
+        segments.append({
+            "kind": "action",
+            "label": action.get("action"),
+            "text": " ".join(str(action.get(k)) for k in ("action", "participants") if action.get(k)),
+            "start_time": start,
+            "end_time": _to_float(action.get("endTime"), start),
+            "confidence": None,
+            "payload": action
+        })
+
+    return segments
+
+
+class TimelineIndex:
+    """基于SQLite的时间线索引，全文检索使用FTS5 trigram分词以支持中文子串匹配"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        self.fts_enabled = self._create_fts()
+        self._backfill_terms()
+
+    def _create_fts(self):
+        """创建外部内容FTS表，SQLite不支持FTS5时退化为LIKE查询"""
+        try:
+            self.conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts
+                    USING fts5(label, text, content='segments', content_rowid='id', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS segments_ai AFTER INSERT ON segments BEGIN
+                    INSERT INTO segments_fts(rowid, label, text) VALUES (new.id, new.label, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS segments_ad AFTER DELETE ON segments BEGIN
+                    INSERT INTO segments_fts(segments_fts, rowid, label, text)
+                        VALUES ('delete', old.id, old.label, old.text);
+                END;
+            """)
+            return True
+        except sqlite3.OperationalError as e:
+            logging.warning(f"FTS5不可用，全文检索退化为LIKE查询: {e}")
+            return False
+
+    def _backfill_terms(self):
+        """为加入短关键词词表之前建立的索引补齐词表"""
+        if self.conn.execute("SELECT 1 FROM segment_terms LIMIT 1").fetchone():
+            return
+        rows = self.conn.execute("SELECT id, label FROM segments WHERE label IS NOT NULL").fetchall()
+        if rows:
+            with self.conn:
+                self._insert_terms(rows)
+
+    def _insert_terms(self, rows):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO segment_terms (term, segment_id) VALUES (?, ?)",
+            [(term, row[0]) for row in rows for term in label_terms(row[1])]
+        )
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ingest(self, video_key, result):
+        """写入（或替换）一个视频的分析结果，返回写入的片段数"""
+        segments = extract_segments(result)
+        with self.conn:
+            self.conn.execute("DELETE FROM videos WHERE video_key = ?", (video_key,))
+            cur = self.conn.execute(
+                "INSERT INTO videos (video_key, duration, resolution, frame_rate, analyzed_at) VALUES (?, ?, ?, ?, ?)",
+                (video_key, _to_float(result.get("duration")), result.get("resolution"),
+                 _to_float(result.get("frameRate")), time.time())
+            )
+            video_id = cur.lastrowid
+            self.conn.executemany(
+                "INSERT INTO segments (video_id, kind, label, text, start_time, end_time, confidence, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(video_id, s["kind"], s["label"], s["text"], s["start_time"], s["end_time"],
+                  s["confidence"], json.dumps(s["payload"], ensure_ascii=False)) for s in segments]
+            )
+            self._insert_terms(self.conn.execute(
+                "SELECT id, label FROM segments WHERE video_id = ? AND label IS NOT NULL", (video_id,)
+            ).fetchall())
+        return len(segments)
+
+    def _build_filters(self, text=None, kind=None, label=None, start=None, end=None,
+                       video_key=None, min_confidence=None):
+        """根据查询条件拼接WHERE子句"""
+        where = []
+        params = []
+
+        if text:
+            if len(text.strip()) <= SHORT_TERM_LENGTH:
+                # trigram分词无法匹配少于3个字符的关键词（如"狗"、"汽车"），改查名称词表，避免LIKE全表扫描
+                where.append("s.id IN (SELECT segment_id FROM segment_terms WHERE term = ?)")
+                params.append(text.strip().lower())
+            elif self.fts_enabled:
+                where.append("s.id IN (SELECT rowid FROM segments_fts WHERE segments_fts MATCH ?)")
+                params.append('"' + text.replace('"', '""') + '"')
+            else:
+                where.append("(s.label LIKE ? OR s.text LIKE ?)")
+                params.extend([f"%{text}%", f"%{text}%"])
+        if kind:
+            where.append("s.kind = ?")
+            params.append(kind)
+        if label:
+            where.append("s.label = ?")
+            params.append(label)
+        if end is not None:
+            where.append("s.start_time <= ?")
+            params.append(float(end))
+        if start is not None:
+            where.append("s.end_time >= ?")
+            params.append(float(start))
+        if video_key:
+            where.append("v.video_key = ?")
+            params.append(video_key)
+        if min_confidence is not None:
+            where.append("s.confidence >= ?")
+            params.append(float(min_confidence))
+
+        return (" WHERE " + " AND ".join(where)) if where else "", params
+
+    def query(self, limit=100, **filters):
+        """
+        查询时间线片段
+
+        Args:
+            text: 全文检索关键词（匹配名称和描述；不超过2个字符的关键词只匹配名称）
+            kind: 片段类型 keyframe/scene/object/action
+            label: 精确匹配名称（物体名、场景类型、动作）
+            start/end: 时间窗口，返回与[start, end]有交集的片段
+            video_key: 限定单个视频
+            min_confidence: 物体最低置信度
+            limit: 最大返回条数
+
+        Returns:
+            片段字典列表，按视频和开始时间排序
+        """
+        where, params = self._build_filters(**filters)
+        sql = (
+            "SELECT v.video_key, s.kind, s.label, s.text, s.start_time, s.end_time, s.confidence, s.payload "
+            "FROM segments s JOIN videos v ON v.id = s.video_id"
+            + where + " ORDER BY v.video_key, s.start_time LIMIT ?"
+        )
+        rows = self.conn.execute(sql, params + [int(limit)]).fetchall()
+        return [
+            {
+                "video_key": r["video_key"],
+                "kind": r["kind"],
+                "label": r["label"],
+                "text": r["text"],
+                "startTime": r["start_time"],
+                "endTime": r["end_time"],
+                "confidence": r["confidence"],
+                "payload": json.loads(r["payload"]) if r["payload"] else None
+            }
+            for r in rows
+        ]
+
+    def videos_matching(self, limit=100, **filters):
+        """返回满足条件的视频列表，例如 "10-20秒之间出现狗的视频" """
+        where, params = self._build_filters(**filters)
+        sql = (
+            "SELECT DISTINCT v.video_key FROM segments s JOIN videos v ON v.id = s.video_id"
+            + where + " ORDER BY v.video_key LIMIT ?"
+        )
+        return [r[0] for r in self.conn.execute(sql, params + [int(limit)]).fetchall()]
+
+    def stats(self):
+        """索引规模统计"""
+        videos = self.conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+        counts = dict(self.conn.execute("SELECT kind, COUNT(*) FROM segments GROUP BY kind").fetchall())
+        return {"videos": videos, "segments": {k: counts.get(k, 0) for k in SEGMENT_KINDS}}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='分析结果时间线索引')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help='SQLite数据库路径')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_ingest = sub.add_parser('ingest', help='导入分析结果JSON')
+    p_ingest.add_argument('--video-key', required=True, help='视频标识（文件名或上传ID）')
+    p_ingest.add_argument('--result', required=True, help='video_analyzer输出或rawAnalysis的JSON文件')
+
+    p_query = sub.add_parser('query', help='查询时间线')
+    p_query.add_argument('--text', help='全文检索关键词')
+    p_query.add_argument('--kind', choices=SEGMENT_KINDS, help='片段类型')
+    p_query.add_argument('--object', help='物体名称（等价于 --kind object --label NAME）')
+    p_query.add_argument('--label', help='精确匹配名称')
+    p_query.add_argument('--start', type=float, help='时间窗口开始（秒）')
+    p_query.add_argument('--end', type=float, help='时间窗口结束（秒）')
+    p_query.add_argument('--video-key', help='限定视频')
+    p_query.add_argument('--min-confidence', type=float, help='最低置信度')
+    p_query.add_argument('--limit', type=int, default=100)
+    p_query.add_argument('--videos-only', action='store_true', help='只返回视频列表')
+
+    sub.add_parser('stats', help='索引统计')
+
+    args = parser.parse_args()
+
+    with TimelineIndex(args.db) as index:
+        if args.command == 'ingest':
+            with open(args.result, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+            # 兼容video_analyzer的完整输出
+            if isinstance(result.get("data"), dict):
+                result = result["data"].get("rawAnalysis", result["data"])
+            count = index.ingest(args.video_key, result)
+            output = {"success": True, "video_key": args.video_key, "segments": count}
+        elif args.command == 'query':
+            filters = {
+                "text": args.text,
+                "kind": "object" if args.object else args.kind,
+                "label": args.object or args.label,
+                "start": args.start,
+                "end": args.end,
+                "video_key": args.video_key,
+                "min_confidence": args.min_confidence,
+                "limit": args.limit
+            }
+            started = time.perf_counter()
+            if args.videos_only:
+                rows = index.videos_matching(**filters)
+            else:
+                rows = index.query(**filters)
+            output = {
+                "success": True,
+                "count": len(rows),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+                "results": rows
+            }
+        else:
+            output = index.stats()
+
+    print(json.dumps(output, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,20 +9,51 @@ import tempfile
 import urllib.request
 import urllib.parse
 
-def download_http_to_temp(http_url):
-    """下载HTTP URL到临时文件，返回本地路径"""
+from mp4_probe import probe_mp4, is_mp4_family
+from resource_governor import ResourceGovernor, AdmissionTimeout
+from dashscope_client import call_multimodal, prefer_streaming, stream_multimodal
+from model_cascade import (REQUIRED_FIELDS, default_model, load_cascade_stages, run_cascade, validate_result,
+                           record_cascade, repair_truncated_json)
+from deadline import Deadline, DeadlineExceeded
+from continuation import finish_reason, is_truncated, resume_truncated
+from audio_analysis import analyze_audio, prompt_context
+
+# 剩余时间少于该值时降低抽帧率
+LOW_BUDGET_SECONDS = 60
+
+# 为构建和输出结果保留的时间
+OUTPUT_RESERVE_SECONDS = 3
+
+# 本地音频分析的最长耗时
+AUDIO_TIMEOUT_SECONDS = 30
+
+def download_http_to_temp(http_url, deadline=None):
+    """下载HTTP URL到临时文件，返回本地路径；超过截止时间时抛出DeadlineExceeded"""
     if not http_url.startswith(('http://', 'https://')):
         return http_url  # 不是HTTP URL，直接返回
 
+    temp_path = None
     try:
         # 创建临时文件
         with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_file:
             temp_path = temp_file.name
 
         logging.info(f"正在下载视频文件: {http_url}")
-        urllib.request.urlretrieve(http_url, temp_path)
+        timeout = deadline.budget(cap=60) if deadline else 60
+        with urllib.request.urlopen(http_url, timeout=max(timeout, 1)) as resp, open(temp_path, 'wb') as out:
+            while True:
+                if deadline:
+                    deadline.check('download')
+                chunk = resp.read(1024 * 1024)
+                if not chunk:
+                    break
+                out.write(chunk)
         logging.info(f"视频文件下载完成: {temp_path}")
         return temp_path
+    except DeadlineExceeded:
+        if temp_path and os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
     except Exception as e:
         logging.error(f"下载视频文件失败: {e}")
         return http_url  # 下载失败，返回原URL
@@ -33,14 +64,14 @@ def to_file_url(p):
         return 'file://' + p.replace('\\', '/')
     return 'file://' + p
 
-def get_duration_with_ffprobe(video_path):
+def get_duration_with_ffprobe(video_path, timeout=10):
     """使用ffprobe获取视频持续时间"""
     try:
         cmd = [
             'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
             '-of', 'csv=p=0', video_path
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
         if result.returncode == 0 and result.stdout.strip():
             duration = float(result.stdout.strip())
             return duration if duration > 0 else None
@@ -64,15 +95,21 @@ def get_duration_with_opencv_method2(video_path):
         pass
     return None
 
-def read_video_meta(local_path):
-    """读取视频元数据，使用多种方法确保准确性"""
+def read_video_meta(local_path, use_header_parser=True, deadline=None):
+    """读取视频元数据，使用多种方法确保准确性
+
+    MP4/MOV文件优先解析容器头部，头部信息完整时不再启动ffprobe和OpenCV；
+    传入deadline时ffprobe的超时不超过剩余时间，时间用尽后跳过OpenCV
+    """
     meta = {
         "duration": 0,
         "frameRate": None,
         "width": None,
         "height": None,
         "frames": None,
+        "codec": None,
         "diagnostics": {
+            "header_parser_success": False,
             "opencv_success": False,
             "ffprobe_success": False,
             "opencv_method2_success": False,
@@ -92,13 +129,28 @@ def read_video_meta(local_path):
         meta["diagnostics"]["errors"].append("文件不存在")
         return meta
 
+    # 方法0：解析MP4/MOV容器头部（无子进程、无解码）
+    if use_header_parser and is_mp4_family(local_path):
+        header = probe_mp4(local_path)
+        if header and header["duration"] > 0 and header["width"] and header["height"] and header["frameRate"]:
+            for k in ["duration", "frameRate", "width", "height", "frames", "codec"]:
+                meta[k] = header[k]
+            meta["diagnostics"]["header_parser_success"] = True
+            logging.info(f"头部解析成功获取duration: {meta['duration']}秒")
+            return meta
+
     # 方法1：使用ffprobe（最可靠）
-    ffprobe_duration = get_duration_with_ffprobe(local_path)
+    ffprobe_timeout = deadline.budget(cap=10) if deadline else 10
+    ffprobe_duration = get_duration_with_ffprobe(local_path, ffprobe_timeout) if ffprobe_timeout > 0 else None
     if ffprobe_duration:
         meta["duration"] = round(ffprobe_duration, 2)
         meta["diagnostics"]["ffprobe_success"] = True
         logging.info(f"ffprobe成功获取duration: {meta['duration']}秒")
 
+    if deadline and deadline.expired():
+        meta["diagnostics"]["errors"].append("截止时间已到，跳过OpenCV读取")
+        return meta
+
     # 方法2：使用OpenCV主要方法
     try:
         import cv2
@@ -145,11 +197,16 @@ def read_video_meta(local_path):
 
     return meta
 
-def call_dashscope(video_path_url, prompt, fps):
+def call_dashscope(video_path_url, prompt, fps, payload_bytes=0, model=None, deadline=None, expected_keys=()):
+    """
+    调用视频理解模型
+
+    启用截止时间且剩余时间不足以等待对冲请求时改用流式输出（流式调用不做对冲），
+    时间到达后用已经收到的部分输出拼出结果，usage中标记partial；剩余时间充裕时仍走可对冲的非流式调用。
+    输出被max_tokens截断时从断点续写，续写情况记录在usage["continuation"]中
+    """
     try:
-        import dashscope
-        from dashscope import MultiModalConversation
-        api_key = os.getenv('DASHSCOPE_API_KEY')
+        # API Key由调用层从Key池（DASHSCOPE_API_KEYS / DASHSCOPE_API_KEY）中分配
         messages = [
             {
                 "role": "user",
@@ -159,26 +216,58 @@ def call_dashscope(video_path_url, prompt, fps):
                 ]
             }
         ]
-        resp = MultiModalConversation.call(
-            api_key=api_key,
-            model='qwen3-vl-plus',
-            messages=messages
-        )
+        timeout = None
+        if deadline is not None and deadline.enabled:
+            deadline.check('model_call')
+            timeout = deadline.budget(reserve=OUTPUT_RESERVE_SECONDS)
+        if prefer_streaming(model or default_model(), payload_bytes, timeout):
+            out, finished, resp, call_info = stream_multimodal(
+                messages,
+                model or default_model(),
+                timeout=timeout,
+                payload_bytes=payload_bytes
+            )
+        else:
+            resp, call_info = call_multimodal(
+                messages,
+                model or default_model(),
+                payload_bytes=payload_bytes,
+                timeout=timeout
+            )
+            out, finished = None, True
+            try:
+                parts = resp.output.choices[0].message.content
+                if isinstance(parts, list) and len(parts) > 0 and isinstance(parts[0], dict):
+                    text = parts[0].get("text")
+                    if text:
+                        out = text
+            except Exception:
+                out = None
         usage = {
             "input_tokens": getattr(getattr(resp, 'usage', None), 'input_tokens', None),
-            "output_tokens": getattr(getattr(resp, 'usage', None), 'output_tokens', None)
+            "output_tokens": getattr(getattr(resp, 'usage', None), 'output_tokens', None),
+            "call": call_info
         }
-        out = None
-        try:
-            parts = resp.output.choices[0].message.content
-            if isinstance(parts, list) and len(parts) > 0 and isinstance(parts[0], dict):
-                text = parts[0].get("text")
-                if text:
-                    out = text
-        except Exception:
-            out = None
         data = None
-        if out:
+        truncated = finished and out and is_truncated(out, finish_reason(resp))
+        if truncated and deadline is not None and deadline.is_short(LOW_BUDGET_SECONDS):
+            # 没有时间续写，只保留已完整输出的字段
+            data = repair_truncated_json(out)
+            usage["partial"] = True
+        elif truncated:
+            def continue_call(continuation_messages):
+                timeout = deadline.budget(reserve=OUTPUT_RESERVE_SECONDS) if deadline is not None else None
+                return call_multimodal(continuation_messages, model or default_model(), payload_bytes=payload_bytes,
+                                       timeout=timeout)[0]
+
+            data, usage["continuation"] = resume_truncated(
+                messages, out, resp, continue_call,
+                expected_keys=expected_keys, first_latency=call_info.get("latency")
+            )
+            if not usage["continuation"]["complete"]:
+                # 只抢救出了部分字段，按部分结果标记
+                usage["partial"] = True
+        elif out:
             s = out.strip()
             try:
                 data = json.loads(s)
@@ -189,7 +278,19 @@ def call_dashscope(video_path_url, prompt, fps):
                         data = json.loads(m.group(0))
                     except Exception:
                         data = None
+        if not finished:
+            usage["partial"] = True
+            if data is None:
+                data = repair_truncated_json(out)
+            logging.warning(f"模型输出在截止时间前未完成，已收到 {len(out or '')} 个字符")
+            if data is None:
+                raise DeadlineExceeded('model_call')
         return data, usage
+    except DeadlineExceeded:
+        raise
+    except TimeoutError:
+        # 非流式调用在截止时间前未返回，没有可用的部分输出
+        raise DeadlineExceeded('model_call')
     except Exception as e:
         return {"error": str(e)}, None
 
@@ -249,22 +350,93 @@ def main():
     parser.add_argument('--video-path', required=True)
     parser.add_argument('--type', default='content')
     parser.add_argument('--fps', type=float, default=2.0)
+    parser.add_argument('--index-db', default=os.getenv('TIMELINE_INDEX_DB', ''), help='分析结果写入的时间线索引数据库路径')
+    parser.add_argument('--video-key', default='', help='时间线索引中的视频标识，默认使用文件名')
+    parser.add_argument('--thumbnails-dir', default='', help='关键帧缩略图和雪碧图的输出目录，为空则不提取')
+    parser.add_argument('--memory-budget-mb', type=float, default=None, help='所有并发分析任务的内存预算（MB）')
+    parser.add_argument('--admission-timeout', type=float, default=120, help='等待内存预算的最长时间（秒）')
+    parser.add_argument('--deadline', type=float, default=float(os.getenv('ANALYSIS_DEADLINE', '0')),
+                        help='整个分析的截止时间（秒），到时返回已完成部分的结果，0表示不限时')
+    parser.add_argument('--no-audio', action='store_true', help='不做本地音频分析')
     parser.add_argument('--prompt', default='请以JSON格式输出：{"duration":秒数,"frameRate":帧率,"resolution":"WxH","frames":总帧数,"keyframeCount":数量,"sceneCount":数量,"objectCount":数量,"actionCount":数量,"keyframes":[],"scenes":[],"objects":[],"actions":[],"vlAnalysis":{},"finalReport":{},"structuredData":{}}')
     args = parser.parse_args()
 
     input_path = args.video_path
     logging.info(f"开始分析视频文件: {input_path}")
 
+    deadline = Deadline(args.deadline)
+
     # 如果是HTTP URL，下载到临时文件
-    local_path = download_http_to_temp(input_path)
+    try:
+        local_path = download_http_to_temp(input_path, deadline)
+    except DeadlineExceeded as e:
+        print(json.dumps({"success": False, "error": str(e), "partial": True, "partial_stage": e.stage,
+                          "deadline": deadline.report()}, ensure_ascii=False))
+        return
     is_temp_file = local_path != input_path
+    deadline.mark('download')
 
+    admission = None
     try:
-        meta = read_video_meta(local_path)
+        # 内存准入控制：非MP4容器读取元数据和提取缩略图时需要打开OpenCV解码器
+        budget_mb = args.memory_budget_mb or float(os.getenv('MEMORY_BUDGET_MB', '2048'))
+        file_size = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+        try:
+            # 本分析器总是以file://方式上传，不产生Base64副本；音频分析和缩略图提取都要在任务内解码
+            admission = ResourceGovernor(budget_mb=budget_mb).admit(
+                [file_size], mode='file',
+                decode=not is_mp4_family(local_path) or bool(args.thumbnails_dir) or not args.no_audio,
+                timeout=deadline.budget(cap=args.admission_timeout)
+            )
+        except AdmissionTimeout as e:
+            print(json.dumps({"success": False, "error": f"服务器繁忙: {str(e)}"}, ensure_ascii=False))
+            return
+        deadline.mark('admission')
+
+        meta = read_video_meta(local_path, deadline=deadline)
+        deadline.mark('metadata')
         logging.info(f"视频元数据: duration={meta['duration']}, frameRate={meta['frameRate']}, resolution={meta['width']}x{meta['height']}")
 
+        # 本地音频分析：响度、静音、节奏和候选剪辑点作为上下文交给模型，剩余时间不多时跳过
+        audio = None
+        prompt = args.prompt
+        if not args.no_audio and not deadline.is_short(LOW_BUDGET_SECONDS):
+            audio = analyze_audio(local_path, timeout=deadline.budget(cap=AUDIO_TIMEOUT_SECONDS))
+            deadline.mark('audio')
+            if audio.get("has_audio"):
+                prompt = f"{prompt}\n{prompt_context(audio)}"
+            else:
+                logging.info(f"跳过音频上下文: {audio.get('error')}")
+
+        stages = load_cascade_stages(args.fps)
+        if deadline.is_short(LOW_BUDGET_SECONDS):
+            # 剩余时间不多时降低抽帧率，减少模型需要处理的帧数
+            logging.warning(f"剩余时间 {deadline.remaining():.0f}秒，抽帧率降至不超过1fps")
+            for stage in stages:
+                stage["fps"] = min(stage.get("fps") or args.fps, 1.0)
+
         url = to_file_url(local_path)
-        ai, usage = call_dashscope(url, args.prompt, args.fps)
+        partial_stage = None
+        cascade_info = None
+        # 提示词要求的是内容分析结构，无论Node传入的--type是什么都按content结构校验
+        schema = 'content'
+        try:
+            # 分级模型级联：第一级结果不完整或置信度过低时才升级到重量级模型
+            (ai, usage), cascade_info = run_cascade(
+                stages,
+                lambda stage: call_dashscope(url, prompt, stage["fps"], payload_bytes=file_size,
+                                             model=stage["model"], deadline=deadline,
+                                             expected_keys=REQUIRED_FIELDS[schema]["keys"]),
+                lambda r: validate_result(r[0], schema),
+                deadline=deadline
+            )
+            record_cascade(schema, cascade_info)
+            if usage and usage.get("partial"):
+                partial_stage = 'model_call'
+        except (DeadlineExceeded, TimeoutError) as e:
+            partial_stage = getattr(e, 'stage', 'model_call')
+            ai, usage = {"error": str(e) or "模型调用超时"}, None
+        deadline.mark('model_call')
 
         if isinstance(ai, dict) and ai.get("error"):
             logging.error(f"AI分析失败: {ai['error']}")
@@ -272,8 +444,41 @@ def main():
             logging.info("AI分析成功")
 
         result = build_result(meta, ai)
+        result["cascade"] = cascade_info
+        result["audio"] = audio
+        if partial_stage:
+            # 截止时间到达时返回元数据和已收到的模型输出，而不是被Node端终止后什么都没有
+            result["partial"] = True
+            result["partial_stage"] = partial_stage
         logging.info(f"最终结果duration: {result['duration']}, 验证状态: {result.get('validation_status')}")
 
+        if args.thumbnails_dir and result.get("keyframes") and not partial_stage and not deadline.expired():
+            try:
+                from frame_pool import FramePool
+                from keyframe_extractor import extract_keyframes, timestamps_from_result
+                with FramePool() as frame_pool:
+                    thumbs = extract_keyframes(local_path, timestamps_from_result(result), args.thumbnails_dir,
+                                               pool=frame_pool)
+                if thumbs.get("success"):
+                    result["thumbnails"] = {"sprite": thumbs["sprite"], "index": thumbs["index"]}
+                    logging.info(f"已提取关键帧缩略图: {thumbs['extracted']} 张, 方式 {thumbs['strategy']}, "
+                                 f"耗时 {thumbs['elapsed_seconds']}秒")
+                else:
+                    logging.warning(f"关键帧缩略图提取失败: {thumbs.get('error')}")
+            except Exception as e:
+                # 缩略图只是附加产物，失败时仍然输出已完成的分析结果
+                logging.warning(f"关键帧缩略图提取失败: {e}")
+
+        if args.index_db and not partial_stage:
+            try:
+                from timeline_index import TimelineIndex
+                video_key = args.video_key or os.path.basename(urllib.parse.urlparse(input_path).path)
+                with TimelineIndex(args.index_db) as index:
+                    count = index.ingest(video_key, result)
+                logging.info(f"已写入时间线索引: {video_key}, 片段数: {count}")
+            except Exception as e:
+                logging.warning(f"写入时间线索引失败: {e}")
+
         o = {
             "success": True,
             "data": {
@@ -281,11 +486,15 @@ def main():
                 "finalReport": ai.get("finalReport") if isinstance(ai, dict) else None,
                 "structuredData": ai.get("structuredData") if isinstance(ai, dict) else None
             },
-            "usage": usage
+            "usage": usage,
+            "resources": admission.report(),
+            "deadline": deadline.report()
         }
         print(json.dumps(o, ensure_ascii=False))
 
     finally:
+        if admission:
+            admission.release()
         # 清理临时文件
         if is_temp_file and os.path.exists(local_path):
             try:
@@ -2,15 +2,19 @@
 # -*- coding: utf-8 -*-
 """
 视频文件诊断工具
-测试test-videos目录中的所有视频文件的元数据提取能力
+测试test-videos目录中的所有视频文件的元数据提取能力；
+--integrity 模式在均匀分布的位置并行解码小窗口，检查截断、缺失moov和moov位置
 """
 
 import os
 import sys
 import json
+import time
 import argparse
 import logging
+import subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # 添加src目录到Python路径
 current_dir = Path(__file__).parent
@@ -19,6 +23,7 @@ sys.path.insert(0, str(src_dir))
 
 try:
     from video_analyzer import read_video_meta, get_duration_with_ffprobe
+    from mp4_probe import scan_layout, is_mp4_family
 except ImportError as e:
     print(f"错误：无法导入video_analyzer模块: {e}")
     print("请确保video_analyzer.py文件存在于正确的位置")
@@ -34,8 +39,195 @@ logging.basicConfig(
     ]
 )
 
-def diagnose_video_file(video_path):
-    """诊断单个视频文件"""
+DEFAULT_SAMPLE_WINDOWS = 8
+DEFAULT_WINDOW_FRAMES = 5
+GB = 1000 ** 3
+
+
+def _decode_window_opencv(video_path, start_frame, window_frames):
+    """用OpenCV从start_frame开始解码window_frames帧，返回成功解码的帧数"""
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return 0, "OpenCV无法打开视频文件"
+    try:
+        if start_frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        decoded = 0
+        for _ in range(window_frames):
+            ok, frame = cap.read()
+            if not ok or frame is None or frame.size == 0:
+                break
+            decoded += 1
+        return decoded, None
+    finally:
+        cap.release()
+
+
+def _decode_window_ffmpeg(video_path, start_time, window_frames):
+    """用ffmpeg从start_time开始解码window_frames帧（输出丢弃），返回成功解码的帧数"""
+    cmd = [
+        'ffmpeg', '-v', 'error', '-nostdin', '-ss', f"{start_time:.3f}", '-i', video_path,
+        '-map', '0:v:0', '-frames:v', str(window_frames), '-f', 'framemd5', '-'
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+    decoded = sum(1 for line in result.stdout.splitlines() if line and not line.startswith('#'))
+    error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else None
+    return decoded, error
+
+
+def _pick_decoder():
+    try:
+        import cv2  # noqa: F401
+        return 'opencv'
+    except ImportError:
+        pass
+    try:
+        subprocess.run(['ffmpeg', '-version'], capture_output=True, timeout=5)
+        return 'ffmpeg'
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def sample_positions(frames, samples, window_frames):
+    """在[0, frames - window_frames]内均匀取samples个起始帧，首尾都包含在内"""
+    last = max(0, frames - window_frames)
+    if samples <= 1 or last == 0:
+        return [0]
+    return sorted({round(last * i / (samples - 1)) for i in range(samples)})
+
+
+def verify_integrity(video_path, samples=DEFAULT_SAMPLE_WINDOWS, window_frames=DEFAULT_WINDOW_FRAMES,
+                     workers=None, faststart_dir=None):
+    """
+    抽样完整性校验：只解码均匀分布的小窗口，而不是整段解码
+
+    Args:
+        samples: 解码窗口数量（包含开头和结尾）
+        window_frames: 每个窗口解码的帧数
+        workers: 解码线程数，默认与窗口数相同
+        faststart_dir: 指定时把moov位于末尾的完整文件以流复制方式重封装到该目录
+
+    Returns:
+        校验结果字典，status为 ok / truncated / missing_moov / malformed / decode_error / unsupported，
+        无法解码任何采样窗口（缺少解码器或读不到帧数和帧率）时为 unverified
+    """
+    started = time.perf_counter()
+    file_size = os.path.getsize(video_path)
+    report = {
+        "status": "ok",
+        "problems": [],
+        "layout": None,
+        "windows": [],
+        "decoder": None
+    }
+
+    if is_mp4_family(video_path):
+        layout = scan_layout(video_path)
+        if layout is None:
+            report["status"] = "unsupported"
+            report["problems"].append("不是有效的MP4/MOV文件")
+        else:
+            report["layout"] = {k: v for k, v in layout.items() if k != "boxes"}
+            report["layout"]["top_level"] = [b["type"] for b in layout["boxes"]]
+            if not layout["has_moov"]:
+                report["problems"].append("缺少moov box，文件上传不完整或录制中断")
+            elif not layout["moov_complete"]:
+                report["problems"].append("moov box不完整，文件上传不完整或录制中断")
+            elif not layout["faststart"]:
+                report["problems"].append(f"moov位于文件末尾（偏移 {layout['moov_offset']}），不利于流式播放和远程读取")
+            if layout["truncated"]:
+                report["problems"].append(f"文件被截断，缺少 {layout['missing_bytes']} 字节")
+            if layout["malformed"]:
+                report["problems"].append(f"偏移 {layout['malformed_offset']} 处的box头无效，之后的结构无法解析")
+
+    meta = read_video_meta(video_path)
+    frames = meta.get("frames") or 0
+    fps = meta.get("frameRate") or 0
+    if not frames and meta.get("duration") and fps:
+        frames = int(meta["duration"] * fps)
+
+    decoder = _pick_decoder()
+    report["decoder"] = decoder
+    if decoder and frames > 0 and fps > 0:
+        positions = sample_positions(frames, samples, window_frames)
+
+        def check(start_frame):
+            try:
+                if decoder == 'opencv':
+                    decoded, error = _decode_window_opencv(video_path, start_frame, window_frames)
+                else:
+                    decoded, error = _decode_window_ffmpeg(video_path, start_frame / fps, window_frames)
+            except Exception as e:
+                decoded, error = 0, str(e)
+            expected = min(window_frames, frames - start_frame)
+            return {
+                "start_frame": start_frame,
+                "timestamp": round(start_frame / fps, 3),
+                "decoded": decoded,
+                "ok": decoded >= expected and not error,
+                "error": error
+            }
+
+        # OpenCV和ffmpeg解码时都不持有GIL，线程即可并行
+        with ThreadPoolExecutor(max_workers=workers or len(positions)) as pool:
+            report["windows"] = list(pool.map(check, positions))
+
+        failed = [w for w in report["windows"] if not w["ok"]]
+        if failed:
+            first = failed[0]["timestamp"]
+            report["problems"].append(f"{len(failed)}/{len(positions)} 个采样窗口解码失败，最早在 {first}秒")
+    elif not decoder:
+        report["problems"].append("OpenCV和ffmpeg均不可用，只检查了文件结构")
+    else:
+        report["problems"].append("无法获取帧数和帧率，未能解码采样窗口")
+
+    layout = report["layout"]
+    failed_windows = [w for w in report["windows"] if not w["ok"]]
+    if layout and not layout["moov_complete"]:
+        report["status"] = "missing_moov"
+    elif (layout and layout["truncated"]) or (failed_windows and failed_windows[-1] is report["windows"][-1]):
+        # 最后一个窗口解码失败通常意味着文件尾部缺失
+        report["status"] = "truncated"
+    elif layout and layout["malformed"]:
+        report["status"] = "malformed"
+    elif failed_windows:
+        report["status"] = "decode_error"
+    elif not report["windows"] and report["status"] == "ok":
+        # 没有解码任何采样窗口，不能判为完整
+        report["status"] = "unverified"
+
+    if faststart_dir and layout and layout["moov_complete"] and not layout["faststart"] and report["status"] == "ok":
+        report["faststart_output"] = remux_faststart(video_path, faststart_dir)
+
+    elapsed = time.perf_counter() - started
+    report["elapsed_seconds"] = round(elapsed, 3)
+    report["footage_seconds"] = meta.get("duration", 0)
+    # 吞吐量按校验覆盖的文件大小计算
+    report["throughput_gb_per_min"] = round(file_size / GB / (elapsed / 60), 3) if elapsed > 0 else None
+    return report
+
+
+def remux_faststart(video_path, output_dir):
+    """用ffmpeg流复制把moov移到文件开头，不重新编码"""
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, os.path.basename(video_path))
+    if os.path.abspath(output_path) == os.path.abspath(video_path):
+        return {"success": False, "error": "输出目录不能与源文件目录相同"}
+    cmd = ['ffmpeg', '-v', 'error', '-nostdin', '-y', '-i', video_path, '-map', '0', '-c', 'copy',
+           '-movflags', '+faststart', output_path]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+    except (OSError, subprocess.SubprocessError) as e:
+        return {"success": False, "error": f"ffmpeg不可用: {e}"}
+    if result.returncode != 0:
+        return {"success": False, "error": result.stderr.strip()}
+    return {"success": True, "path": output_path}
+
+
+def diagnose_video_file(video_path, integrity=False, **integrity_options):
+    """诊断单个视频文件，integrity为True时追加抽样完整性校验"""
     video_path = os.path.abspath(video_path)
 
     if not os.path.exists(video_path):
@@ -91,6 +283,15 @@ def diagnose_video_file(video_path):
         diagnosis["ffprobe_available"] = False
         diagnosis["ffprobe_error"] = str(e)
 
+    if integrity:
+        report = verify_integrity(video_path, **integrity_options)
+        diagnosis["integrity"] = report
+        if report["status"] not in ("ok", "unsupported", "unverified"):
+            # 头部完整但内容缺失的文件会在模型阶段才失败，这里提前判为失败
+            diagnosis["diagnosis_success"] = False
+            diagnosis["validation_status"] = "failed"
+            diagnosis["recommendation"] = "；".join(report["problems"])
+
     return diagnosis
 
 def generate_recommendation(meta):
@@ -115,7 +316,7 @@ def generate_recommendation(meta):
 
     return "未识别的问题，需要进一步检查"
 
-def diagnose_test_videos_directory(test_videos_path):
+def diagnose_test_videos_directory(test_videos_path, integrity=False, **integrity_options):
     """诊断test-videos目录中的所有视频文件"""
     test_videos_path = os.path.abspath(test_videos_path)
 
@@ -144,7 +345,7 @@ def diagnose_test_videos_directory(test_videos_path):
             results["total_files"] += 1
 
             # 诊断每个文件
-            diagnosis = diagnose_video_file(file_path)
+            diagnosis = diagnose_video_file(file_path, integrity, **integrity_options)
             results["files"].append(diagnosis)
 
             if diagnosis.get("is_video", False):
@@ -155,6 +356,17 @@ def diagnose_test_videos_directory(test_videos_path):
                 else:
                     results["failed_analyses"] += 1
 
+    if integrity:
+        reports = [f["integrity"] for f in results["files"] if f.get("integrity")]
+        elapsed = sum(r["elapsed_seconds"] for r in reports)
+        verified = sum(f["file_size_bytes"] for f in results["files"] if f.get("integrity"))
+        results["integrity_summary"] = {
+            "files": len(reports),
+            "by_status": {s: sum(1 for r in reports if r["status"] == s) for s in {r["status"] for r in reports}},
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_gb_per_min": round(verified / GB / (elapsed / 60), 3) if elapsed > 0 else None
+        }
+
     # 计算成功率
     if results["video_files"] > 0:
         results["success_rate"] = round(results["successful_analyses"] / results["video_files"] * 100, 2)
@@ -219,6 +431,19 @@ def print_diagnosis_summary(results):
         else:
             print(f"   FFprobe: 不可用")
 
+        integrity = file_result.get("integrity")
+        if integrity:
+            layout = integrity.get("layout") or {}
+            windows = integrity.get("windows", [])
+            print(f"   完整性: {integrity['status']}, 采样窗口 {sum(1 for w in windows if w['ok'])}/{len(windows)} 通过, "
+                  f"moov偏移: {layout.get('moov_offset')}, faststart: {layout.get('faststart')}")
+            print(f"   校验吞吐量: {integrity['throughput_gb_per_min']} GB/分钟")
+
+    summary = results.get("integrity_summary")
+    if summary:
+        print(f"\n完整性校验: {summary['files']} 个文件, {summary['by_status']}, "
+              f"吞吐量 {summary['throughput_gb_per_min']} GB/分钟")
+
 def main():
     parser = argparse.ArgumentParser(description="视频文件诊断工具")
     parser.add_argument(
@@ -239,13 +464,47 @@ def main():
         action='store_true',
         help='显示详细输出'
     )
+    parser.add_argument(
+        '--integrity',
+        action='store_true',
+        help='抽样解码校验文件完整性（截断、缺失moov、moov位置）'
+    )
+    parser.add_argument(
+        '--samples',
+        type=int,
+        default=DEFAULT_SAMPLE_WINDOWS,
+        help=f'完整性校验的解码窗口数 (默认: {DEFAULT_SAMPLE_WINDOWS})'
+    )
+    parser.add_argument(
+        '--window-frames',
+        type=int,
+        default=DEFAULT_WINDOW_FRAMES,
+        help=f'每个窗口解码的帧数 (默认: {DEFAULT_WINDOW_FRAMES})'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='解码线程数 (默认: 与窗口数相同)'
+    )
+    parser.add_argument(
+        '--faststart-dir',
+        help='把moov位于末尾的文件以流复制方式重封装为faststart并输出到该目录'
+    )
 
     args = parser.parse_args()
+    integrity_options = {
+        "samples": args.samples,
+        "window_frames": args.window_frames,
+        "workers": args.workers,
+        "faststart_dir": args.faststart_dir
+    }
+    integrity = args.integrity or bool(args.faststart_dir)
 
     if args.file:
         # 诊断单个文件
         print(f"正在诊断单个文件: {args.file}")
-        result = diagnose_video_file(args.file)
+        result = diagnose_video_file(args.file, integrity, **integrity_options)
 
         if args.verbose:
             print(json.dumps(result, indent=2, ensure_ascii=False))
@@ -259,7 +518,7 @@ def main():
     else:
         # 诊断整个test-videos目录
         print(f"正在诊断目录: {args.test_videos_dir}")
-        results = diagnose_test_videos_directory(args.test_videos_dir)
+        results = diagnose_test_videos_directory(args.test_videos_dir, integrity, **integrity_options)
 
         print_diagnosis_summary(results)
 
@@ -249,7 +249,9 @@ class AIService {
         const args = [
           scriptPath,
           '--video-path', localVideoPath,
-          '--type', analysisType
+          '--type', analysisType,
+          // 比下方的进程超时早10秒结束，超时前返回已完成部分的结果
+          '--deadline', '170'
         ];
 
         if (videoPath2) {